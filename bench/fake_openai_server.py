@@ -0,0 +1,191 @@
+import argparse
+import json
+import random
+import threading
+import time
+import uuid
+import zlib
+import numpy as np
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+FAKE_PAPER_INFO = {
+    'keywords': ['trust', 'platform', 'adoption'],
+    'summary': 'A synthetic summary of the paper.',
+    'content': [{
+        'type': 'hypothesis',
+        'description': 'Trust is positively associated with adoption.',
+        'iv': 'trust',
+        'iv_description': 'The trust of the user in the platform.',
+        'dv': 'adoption',
+        'dv_description': 'The adoption of the platform.',
+        'method': 'survey',
+        'result': 'supported',
+        'conclusion': 'Trust increases adoption.',
+    }],
+}
+
+
+def fake_embedding(item, dimensions):
+    """A deterministic unit vector of the input, which can be a string or a list of token ids"""
+    seed = zlib.crc32(json.dumps(item).encode('utf-8'))
+    vector = np.random.RandomState(seed).standard_normal(dimensions)
+    return (vector / np.linalg.norm(vector)).tolist()
+
+
+def count_tokens(text):
+    return len(str(text)) // 4 + 1
+
+
+def chat_response(body):
+    prompt_tokens = sum(count_tokens(message.get('content', '')) for message in body.get('messages', []))
+    content = json.dumps(FAKE_PAPER_INFO)
+    return {
+        'id': f'chatcmpl-{uuid.uuid4().hex}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': body.get('model', 'fake'),
+        'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': content}, 'finish_reason': 'stop'}],
+        'usage': {'prompt_tokens': prompt_tokens, 'completion_tokens': count_tokens(content), 'total_tokens': prompt_tokens + count_tokens(content)},
+    }
+
+
+def embedding_response(body):
+    inputs = body['input'] if isinstance(body['input'], list) and body['input'] and not isinstance(body['input'][0], int) else [body['input']]
+    dimensions = body.get('dimensions') or 1024
+    prompt_tokens = sum(len(i) if isinstance(i, list) else count_tokens(i) for i in inputs)
+    return {
+        'object': 'list',
+        'model': body.get('model', 'fake'),
+        'data': [{'object': 'embedding', 'index': i, 'embedding': fake_embedding(item, dimensions)} for i, item in enumerate(inputs)],
+        'usage': {'prompt_tokens': prompt_tokens, 'total_tokens': prompt_tokens},
+    }
+
+
+class FakeOpenAIHandler(BaseHTTPRequestHandler):
+    """
+    A stand-in for the OpenAI-compatible API: chat completions, embeddings, and the files and batches
+    endpoints of the batch API. Batches complete as soon as they are retrieved.
+    """
+    server_version = 'FakeOpenAI/0.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, payload, headers=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def simulate(self):
+        """Sleep for the configured latency, return False if the request should be rate limited"""
+        state = self.server.state
+        time.sleep(max(random.gauss(state['latency'], state['latency'] * 0.2), 0))
+        with state['lock']:
+            state['requests'] += 1
+            if random.random() < state['rate_429']:
+                state['rate_limited'] += 1
+                return False
+        return True
+
+    def read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def do_POST(self):
+        raw = self.read_body()
+        path = self.path.split('?')[0].removeprefix('/v1')
+        state = self.server.state
+
+        if path in ('/chat/completions', '/embeddings'):
+            if not self.simulate():
+                self.send_json(429, {'error': {'message': 'Rate limit reached', 'type': 'rate_limit_error'}}, {'Retry-After': '1'})
+                return
+            body = json.loads(raw)
+            self.send_json(200, chat_response(body) if path == '/chat/completions' else embedding_response(body))
+        elif path == '/files':
+            # The multipart body is kept as is, the batch lines are found by scanning for json lines
+            file_id = f'file-{uuid.uuid4().hex}'
+            lines = [i for i in raw.decode('utf-8', errors='ignore').splitlines() if i.startswith('{')]
+            state['files'][file_id] = '\n'.join(lines)
+            self.send_json(200, {'id': file_id, 'object': 'file', 'bytes': len(raw), 'created_at': int(time.time()), 'filename': 'batch.jsonl', 'purpose': 'batch', 'status': 'processed'})
+        elif path == '/batches':
+            body = json.loads(raw)
+            batch_id = f'batch_{uuid.uuid4().hex}'
+            state['batches'][batch_id] = {
+                'id': batch_id, 'object': 'batch', 'endpoint': body['endpoint'], 'input_file_id': body['input_file_id'],
+                'completion_window': body['completion_window'], 'status': 'in_progress', 'created_at': int(time.time()),
+                'output_file_id': None, 'error_file_id': None,
+            }
+            self.send_json(200, state['batches'][batch_id])
+        else:
+            self.send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+    def do_GET(self):
+        path = self.path.split('?')[0].removeprefix('/v1')
+        state = self.server.state
+
+        if path.startswith('/batches/'):
+            batch = state['batches'].get(path.split('/')[2])
+            if batch is None:
+                self.send_json(404, {'error': {'message': 'Unknown batch'}})
+                return
+            if batch['status'] == 'in_progress':
+                outputs = []
+                for line in state['files'][batch['input_file_id']].splitlines():
+                    request = json.loads(line)
+                    outputs.append(json.dumps({
+                        'id': f'batch_req_{uuid.uuid4().hex}', 'custom_id': request['custom_id'], 'error': None,
+                        'response': {'status_code': 200, 'request_id': uuid.uuid4().hex, 'body': chat_response(request['body'])},
+                    }))
+                output_file_id = f'file-{uuid.uuid4().hex}'
+                state['files'][output_file_id] = '\n'.join(outputs)
+                batch['output_file_id'] = output_file_id
+                batch['status'] = 'completed'
+            self.send_json(200, batch)
+        elif path.startswith('/files/') and path.endswith('/content'):
+            content = state['files'].get(path.split('/')[2])
+            if content is None:
+                self.send_json(404, {'error': {'message': 'Unknown file'}})
+                return
+            data = content.encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/jsonl')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+        else:
+            self.send_json(404, {'error': {'message': f'Unknown path {self.path}'}})
+
+
+def start_server(host='127.0.0.1', port=0, latency=0.05, rate_429=0.0):
+    """Start the fake server in a background thread, the base url is http://{host}:{server.server_port}/v1"""
+    server = ThreadingHTTPServer((host, port), FakeOpenAIHandler)
+    server.daemon_threads = True
+    server.state = {
+        'latency': latency, 'rate_429': rate_429, 'lock': threading.Lock(),
+        'requests': 0, 'rate_limited': 0, 'files': {}, 'batches': {},
+    }
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--host', type=str, default='127.0.0.1', help='The host to listen on')
+    args.add_argument('--port', type=int, default=8001, help='The port to listen on')
+    args.add_argument('--latency', type=float, default=0.05, help='The mean latency (in seconds) of the chat and embedding requests')
+    args.add_argument('--rate_429', type=float, default=0.0, help='The share of the chat and embedding requests answered with 429')
+    args = args.parse_args()
+
+    server = start_server(args.host, args.port, args.latency, args.rate_429)
+    print(f'[INFO] Fake OpenAI server listening on http://{args.host}:{server.server_port}/v1')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,193 @@
+import os
+import argparse
+import asyncio
+import json
+import random
+import shutil
+import subprocess
+import time
+from argparse import Namespace
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.synthetic_corpus import generate_corpus, words
+from bench.fake_openai_server import start_server
+
+
+STAGES = ['generate', 'create_db', 'chunk', 'embed', 'search', 'extract']
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(int(len(values) * q), len(values) - 1)]
+
+
+def get_git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except Exception:
+        return ''
+
+
+def bench_create_db(args):
+    from rag.db import create_db
+    db_args = Namespace(db_path=os.path.join(args.work_dir, 'ingest.db'), scopus_csvs=[args.scopus_csv], init=True)
+    if os.path.exists(db_args.db_path):
+        os.remove(db_args.db_path)
+    create_db.main(db_args)
+    db_args.init = False
+
+    start = time.perf_counter()
+    create_db.main(db_args)
+    return {'items': args.num_papers, 'seconds': time.perf_counter() - start}
+
+
+def bench_chunk(args):
+    from rag.embed.md_loader import get_paper_docs_recursive
+    start = time.perf_counter()
+    chunks = 0
+    for paper_id in range(1, args.num_papers + 1):
+        chunks += len(get_paper_docs_recursive(str(paper_id), args))
+    return {'items': args.num_papers, 'seconds': time.perf_counter() - start, 'chunks': chunks}
+
+
+def get_vectorstore(args):
+    from langchain_chroma import Chroma
+    from langchain_openai import OpenAIEmbeddings
+    # The fake server does not tokenize, so send the texts as they are
+    embeddings = OpenAIEmbeddings(model='fake-embedding', dimensions=1024, check_embedding_ctx_length=False)
+    return Chroma(
+        embedding_function=embeddings,
+        persist_directory=os.path.join(args.work_dir, 'chroma'),
+        collection_name='bench',
+    )
+
+
+async def bench_embed(args):
+    from rag.embed.create_embed import handle_one_paper
+    shutil.rmtree(os.path.join(args.work_dir, 'chroma'), ignore_errors=True)
+    vectorstore = get_vectorstore(args)
+    embed_args = Namespace(**vars(args), recursive=True)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    paper_ids = [str(i) for i in range(1, min(args.num_papers, args.max_api_papers) + 1)]
+    start = time.perf_counter()
+    results = await asyncio.gather(*[handle_one_paper(paper_id, vectorstore, semaphore, embed_args) for paper_id in paper_ids])
+    return {
+        'items': len(paper_ids), 'seconds': time.perf_counter() - start,
+        'chunks': sum(r['count'] for r in results), 'errors': sum(1 for r in results if r['status'] != 'success'),
+    }
+
+
+def bench_search(args):
+    from rag.embed.use_embed import get_docs_by_query
+    vectorstore = get_vectorstore(args)
+    rng = random.Random(args.seed)
+    latencies = []
+    start = time.perf_counter()
+    for _ in range(args.num_queries):
+        query_start = time.perf_counter()
+        get_docs_by_query(words(rng, 8), vectorstore, k=10)
+        latencies.append(time.perf_counter() - query_start)
+    return {
+        'items': args.num_queries, 'seconds': time.perf_counter() - start,
+        'p50_ms': percentile(latencies, 0.5) * 1000, 'p95_ms': percentile(latencies, 0.95) * 1000,
+    }
+
+
+async def bench_extract(args):
+    from rag.chat.extract_paper_info import process_paper_by_id
+    output_dir = os.path.join(args.work_dir, 'papers_info')
+    shutil.rmtree(output_dir, ignore_errors=True)
+    os.makedirs(output_dir)
+    extract_args = Namespace(**vars(args), output_dir=output_dir, model='fake-chat', map_reduce=False)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    paper_ids = [str(i) for i in range(1, min(args.num_papers, args.max_api_papers) + 1)]
+    start = time.perf_counter()
+    results = await asyncio.gather(*[process_paper_by_id(paper_id, extract_args, semaphore, 0) for paper_id in paper_ids])
+    return {'items': len(paper_ids), 'seconds': time.perf_counter() - start, 'errors': sum(1 for r in results if not r)}
+
+
+def run_stage(stage, args):
+    if stage == 'generate':
+        start = time.perf_counter()
+        generate_corpus(args)
+        return {'items': args.num_papers, 'seconds': time.perf_counter() - start}
+    if stage == 'create_db':
+        return bench_create_db(args)
+    if stage == 'chunk':
+        return bench_chunk(args)
+    if stage == 'embed':
+        return asyncio.run(bench_embed(args))
+    if stage == 'search':
+        return bench_search(args)
+    if stage == 'extract':
+        return asyncio.run(bench_extract(args))
+
+
+def load_previous_results(results_path):
+    """Get the latest previous result of each (stage, num_papers)"""
+    previous = {}
+    if os.path.exists(results_path):
+        with open(results_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                result = json.loads(line)
+                previous[(result['stage'], result['num_papers'])] = result
+    return previous
+
+
+def main(args):
+    server = start_server(latency=args.latency, rate_429=args.rate_429)
+    os.environ['OPENAI_BASE_URL'] = os.environ['OPENAI_API_BASE'] = f'http://127.0.0.1:{server.server_port}/v1'
+    os.environ['OPENAI_API_KEY'] = 'fake'
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.results_path)), exist_ok=True)
+    previous = load_previous_results(args.results_path)
+    git_commit = get_git_commit()
+
+    for num_papers in args.sizes:
+        run_args = Namespace(**vars(args))
+        run_args.num_papers = num_papers
+        run_args.work_dir = os.path.join(args.bench_dir, str(num_papers))
+        run_args.papers_mineru_dir = os.path.join(run_args.work_dir, 'papers_mineru')
+        run_args.db_path = os.path.join(run_args.work_dir, 'db', 'academy.db')
+        run_args.scopus_csv = os.path.join(run_args.work_dir, 'scopus.csv')
+        os.makedirs(run_args.work_dir, exist_ok=True)
+
+        for stage in args.stages:
+            print(f'[INFO] Benchmarking {stage} with {num_papers} papers...')
+            result = run_stage(stage, run_args)
+            result.update({
+                'stage': stage, 'num_papers': num_papers, 'items_per_second': result['items'] / max(result['seconds'], 1e-9),
+                'latency': args.latency, 'rate_429': args.rate_429, 'git_commit': git_commit, 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            })
+            with open(args.results_path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(result) + '\n')
+
+            change = ''
+            if (stage, num_papers) in previous:
+                before = previous[(stage, num_papers)]
+                change = f" ({result['items_per_second'] / max(before['items_per_second'], 1e-9) - 1:+.1%} vs {before['git_commit'] or before['timestamp']})"
+            print(f"[INFO] {stage}: {result['items']} items in {result['seconds']:.2f}s, {result['items_per_second']:.1f} items/s{change}")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000], help='The numbers of papers to benchmark')
+    args.add_argument('--stages', type=str, nargs='+', default=STAGES, choices=STAGES, help='The stages to benchmark')
+    args.add_argument('--bench_dir', type=str, default='./export/bench', help='The path to the generated corpora')
+    args.add_argument('--results_path', type=str, default='./export/bench/results.jsonl', help='The path to append the results to')
+    args.add_argument('--max_api_papers', type=int, default=1000, help='The maximum number of papers sent to the fake API in the embed and extract stages')
+    args.add_argument('--num_queries', type=int, default=200, help='Number of search queries')
+    args.add_argument('--concurrency', type=int, default=10, help='The concurrency of the embed and extract stages')
+    args.add_argument('--latency', type=float, default=0.05, help='The mean latency (in seconds) of the fake API')
+    args.add_argument('--rate_429', type=float, default=0.0, help='The share of the fake API requests answered with 429')
+    args.add_argument('--seed', type=int, default=0, help='The random seed')
+    args = args.parse_args()
+
+    main(args)
@@ -0,0 +1,123 @@
+import os
+import argparse
+import random
+import sqlite3
+import pandas as pd
+from tqdm import tqdm
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rag.db.create_db import create_db
+
+
+JOURNALS = [
+    'MIS Quarterly',
+    'Information Systems Research',
+    'Journal of Management Information Systems',
+    'Journal of the Association for Information Systems',
+    'European Journal of Information Systems',
+    'Information Systems Journal',
+    'Journal of Information Technology',
+    'Journal of Strategic Information Systems',
+]
+WORDS = (
+    'trust adoption platform digital online social mobile network user firm market information system '
+    'technology performance value knowledge governance privacy security sharing community crowdsourcing '
+    'recommendation review rating consumer seller buyer channel search capability innovation outsourcing '
+    'enterprise software cloud data analytics algorithm artificial intelligence health care learning '
+    'behavior intention satisfaction quality effect impact role evidence theory model design experiment'
+).split()
+BOILERPLATE = [
+    'Downloaded from informs.org by [203.0.113.7] on 03 March 2019, at 02:14. For personal use only, all rights reserved.',
+    'Copyright © 2016, INFORMS. All rights reserved.',
+    'This article was downloaded by: [University Library] On: 12 May 2018',
+]
+
+
+def words(rng, n):
+    return ' '.join(rng.choice(WORDS) for _ in range(n))
+
+
+def sentences(rng, n):
+    return ' '.join(f'{words(rng, rng.randint(8, 20)).capitalize()}.' for _ in range(n))
+
+
+def paragraphs(rng, n):
+    return '\n\n'.join(sentences(rng, rng.randint(3, 8)) for _ in range(n))
+
+
+def generate_paper_md(rng, title, journal):
+    """Generate a markdown paper in the shape of the MinerU output"""
+    hypotheses = '\n\n'.join(
+        f'H{i + 1}: {words(rng, 3).capitalize()} is positively associated with {words(rng, 3)}.'
+        for i in range(rng.randint(0, 6))
+    )
+    references = '\n\n'.join(
+        f'{words(rng, 2).title()}, A. ({rng.randint(1980, 2020)}). {words(rng, 8).capitalize()}. {rng.choice(JOURNALS)}, {rng.randint(1, 40)}({rng.randint(1, 4)}), {rng.randint(1, 900)}-{rng.randint(1, 900)}.'
+        for _ in range(rng.randint(20, 60))
+    )
+    sections = [
+        f'# {journal}',
+        f'# {title}',
+        rng.choice(BOILERPLATE),
+        f'# A B S T R A C T\n\n{sentences(rng, 6)}',
+        f'# 1. Introduction\n\n{paragraphs(rng, rng.randint(3, 8))}',
+        f'# 2. Theoretical Background\n\n{paragraphs(rng, rng.randint(2, 6))}',
+        f'# 2.1. Hypotheses Development\n\n{paragraphs(rng, rng.randint(1, 4))}\n\n{hypotheses}',
+        f'# 3. Research Method\n\n{paragraphs(rng, rng.randint(2, 6))}\n\n![](images/{rng.getrandbits(64):016x}.jpg)',
+        rng.choice(BOILERPLATE),
+        f'# 4. Results\n\n{paragraphs(rng, rng.randint(2, 6))}',
+        f'# 5. Discussion and Conclusions\n\n{paragraphs(rng, rng.randint(2, 5))}',
+        f'# References\n\n{references}',
+    ]
+    return '\n\n'.join(sections)
+
+
+def generate_corpus(args):
+    """
+    Generate args.num_papers fake papers: the MinerU markdown folders, a matching academy.db,
+    and a scopus csv with the same papers to benchmark the ingest.
+    """
+    rng = random.Random(args.seed)
+    os.makedirs(args.papers_mineru_dir, exist_ok=True)
+    os.makedirs(os.path.dirname(os.path.abspath(args.db_path)), exist_ok=True)
+    if os.path.exists(args.db_path):
+        os.remove(args.db_path)
+    create_db(args)
+
+    rows = []
+    for paper_id in tqdm(range(1, args.num_papers + 1), desc="Generating papers", unit="paper"):
+        title = f'{words(rng, rng.randint(5, 12)).title()} {paper_id}'
+        journal = rng.choice(JOURNALS)
+        rows.append({
+            '文献标题': title,
+            'DOI': f'10.0000/synthetic.{paper_id}',
+            '年份': rng.randint(2005, 2020),
+            '作者': '; '.join(f'{words(rng, 1).title()} {chr(rng.randint(65, 90))}.' for _ in range(rng.randint(1, 5))),
+            '来源出版物名称': journal,
+        })
+        paper_dir = os.path.join(args.papers_mineru_dir, str(paper_id), 'txt')
+        os.makedirs(paper_dir, exist_ok=True)
+        with open(os.path.join(paper_dir, f'{paper_id}.md'), 'w', encoding='utf-8') as f:
+            f.write(generate_paper_md(rng, title, journal))
+
+    conn = sqlite3.connect(args.db_path)
+    conn.executemany('''
+        INSERT INTO paper (id, title, doi, year, authors, journal, file_exists) VALUES (?, ?, ?, ?, ?, ?, 1)
+    ''', [(i + 1, row['文献标题'], row['DOI'], row['年份'], row['作者'], row['来源出版物名称']) for i, row in enumerate(rows)])
+    conn.commit()
+    conn.close()
+
+    pd.DataFrame(rows).to_csv(args.scopus_csv, index=False)
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--num_papers', type=int, default=1000, help='Number of papers to generate')
+    args.add_argument('--papers_mineru_dir', type=str, default='./export/bench/papers_mineru', help='The path to the generated md directory')
+    args.add_argument('--db_path', type=str, default='./export/bench/db/academy.db', help='The path to the generated database file')
+    args.add_argument('--scopus_csv', type=str, default='./export/bench/scopus.csv', help='The path to the generated scopus csv')
+    args.add_argument('--seed', type=int, default=0, help='The random seed')
+    args = args.parse_args()
+
+    generate_corpus(args)
@@ -0,0 +1,257 @@
+import os
+import asyncio
+import json
+from dotenv import load_dotenv, find_dotenv
+_ = load_dotenv(find_dotenv())
+
+from openai import AsyncOpenAI
+from tqdm import tqdm
+import argparse
+
+import sys, os
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag.embed.md_loader import get_paper_md
+from rag.chat.extract_paper_info import get_prompt, get_the_main_content, parse_paper_info, is_extracted
+from rag.lib.metrics import metrics
+
+
+# Batches in these states will not produce (more) results, their unfinished papers are queued again
+TERMINAL_STATUSES = ('completed', 'failed', 'expired', 'cancelled')
+ROLES = {'system': 'system', 'human': 'user', 'ai': 'assistant'}
+
+
+def load_state(args):
+    """Load the batch state, which records every batch file and its remote status"""
+    state_path = os.path.join(args.batch_dir, 'state.json')
+    if not os.path.exists(state_path):
+        return {'batches': []}
+    with open(state_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_state(state, args):
+    state_path = os.path.join(args.batch_dir, 'state.json')
+    with open(f'{state_path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(state, f, indent=2)
+    os.replace(f'{state_path}.tmp', state_path)
+
+
+def get_pending_paper_ids(state, args):
+    """
+    Get the papers that have no output yet and are not in an unfinished batch.
+    A paper that was in max_attempts finished batches without an output is not queued again.
+    """
+    in_flight, attempts = set(), {}
+    for batch in state['batches']:
+        if batch['status'] not in TERMINAL_STATUSES:
+            in_flight.update(batch['paper_ids'])
+        else:
+            for paper_id in batch['paper_ids']:
+                attempts[paper_id] = attempts.get(paper_id, 0) + 1
+
+    paper_ids = [i for i in os.listdir(args.papers_mineru_dir) if os.path.isdir(os.path.join(args.papers_mineru_dir, i))]
+    paper_ids = [i for i in sorted(paper_ids) if i not in in_flight and not is_extracted(i, args.output_dir)]
+    exhausted = [i for i in paper_ids if attempts.get(i, 0) >= args.max_attempts]
+    if exhausted:
+        print(f"[WARNING] {len(exhausted)} papers failed in {args.max_attempts} batches and are not queued again, see the .errors.jsonl files in {args.batch_dir}")
+    return [i for i in paper_ids if attempts.get(i, 0) < args.max_attempts]
+
+
+async def build_request(paper_id, prompt, format_instructions, args):
+    """Build one request line of the batch file, return None if the paper has no markdown"""
+    paper_md = get_paper_md(paper_id, args)
+    if not paper_md:
+        return None
+    paper_md = await get_the_main_content(paper_md)
+
+    messages = prompt.format_messages(text=paper_md, format_instructions=format_instructions)
+    return {
+        'custom_id': str(paper_id),
+        'method': 'POST',
+        'url': '/v1/chat/completions',
+        'body': {
+            'model': args.model,
+            'temperature': 0,
+            'messages': [{'role': ROLES[message.type], 'content': message.content} for message in messages],
+        },
+    }
+
+
+async def prepare_batches(state, args):
+    """Write the pending papers into batch files in the OpenAI batch format"""
+    paper_ids = get_pending_paper_ids(state, args)
+    print(f"[INFO] Found {len(paper_ids)} pending papers")
+    prompt, format_instructions = get_prompt()
+
+    batch_file, batch_paper_ids, batch_bytes = None, [], 0
+
+    def close_batch():
+        batch_file.close()
+        state['batches'].append({
+            'file': batch_file.name,
+            'status': 'prepared',
+            'paper_ids': batch_paper_ids,
+        })
+        save_state(state, args)
+
+    for paper_id in tqdm(paper_ids, desc="Preparing batches", unit="paper"):
+        request = await build_request(paper_id, prompt, format_instructions, args)
+        if request is None:
+            continue
+        line = json.dumps(request, ensure_ascii=False) + '\n'
+        line_bytes = len(line.encode('utf-8'))
+
+        if batch_file and (len(batch_paper_ids) >= args.batch_max_requests or batch_bytes + line_bytes > args.batch_max_bytes):
+            close_batch()
+            batch_file = None
+
+        if batch_file is None:
+            batch_path = os.path.join(args.batch_dir, f'batch_{len(state["batches"]):05d}.jsonl')
+            batch_file = open(batch_path, 'w', encoding='utf-8')
+            batch_paper_ids, batch_bytes = [], 0
+
+        batch_file.write(line)
+        batch_paper_ids.append(str(paper_id))
+        batch_bytes += line_bytes
+
+    if batch_file:
+        close_batch()
+
+
+async def submit_batches(client, state, args):
+    """Upload the prepared batch files and create the batches"""
+    for batch in state['batches']:
+        if batch['status'] != 'prepared':
+            continue
+        with open(batch['file'], 'rb') as f:
+            input_file = await client.files.create(file=f, purpose='batch')
+        remote_batch = await client.batches.create(
+            input_file_id=input_file.id,
+            endpoint='/v1/chat/completions',
+            completion_window=args.completion_window,
+        )
+        batch['input_file_id'] = input_file.id
+        batch['batch_id'] = remote_batch.id
+        batch['status'] = remote_batch.status
+        save_state(state, args)
+        print(f"[INFO] Submitted {batch['file']} as {remote_batch.id} with {len(batch['paper_ids'])} papers")
+
+
+def store_results(output_text, args):
+    """Parse the result lines of a batch and store the paper infos"""
+    success_count = 0
+    for line in output_text.splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        paper_id = result['custom_id']
+        response = result.get('response') or {}
+        if result.get('error') or response.get('status_code') != 200:
+            metrics.inc('papers_total', stage='batch', status='failed')
+            print(f"[ERROR] Failed to extract the paper {paper_id}: {result.get('error') or response.get('body')}")
+            continue
+
+        usage = response['body'].get('usage') or {}
+        metrics.add_tokens(response['body'].get('model', args.model), usage.get('prompt_tokens', 0), usage.get('completion_tokens', 0), kind='batch', discount=0.5)
+        content = response['body']['choices'][0]['message']['content']
+        paper_info = parse_paper_info(paper_id, content)
+        if paper_info:
+            # Write then rename, so a crash mid-write does not leave a truncated file that counts as done
+            output_path = os.path.join(args.output_dir, f'{paper_id}.json')
+            with open(f'{output_path}.tmp', 'w', encoding='utf-8') as f:
+                json.dump(paper_info, f, indent=2)
+            os.replace(f'{output_path}.tmp', output_path)
+            success_count += 1
+        metrics.inc('papers_total', stage='batch', status='success' if paper_info else 'failed')
+    return success_count
+
+
+async def poll_batches(client, state, args):
+    """Poll the submitted batches until they finish, then download and store their results"""
+    while True:
+        unfinished = [i for i in state['batches'] if i['status'] not in TERMINAL_STATUSES + ('prepared',)]
+        if not unfinished:
+            return
+
+        for batch in unfinished:
+            remote_batch = await client.batches.retrieve(batch['batch_id'])
+            if remote_batch.status not in TERMINAL_STATUSES:
+                if remote_batch.status != batch['status']:
+                    batch['status'] = remote_batch.status
+                    save_state(state, args)
+                continue
+
+            # Expired and cancelled batches may still have partial results
+            success_count = 0
+            if remote_batch.output_file_id:
+                output = await client.files.content(remote_batch.output_file_id)
+                with open(batch['file'].replace('.jsonl', '.output.jsonl'), 'w', encoding='utf-8') as f:
+                    f.write(output.text)
+                success_count = store_results(output.text, args)
+
+            # A batch failing as a whole, e.g. on validation, only has errors
+            errors = getattr(remote_batch, 'errors', None)
+            for error in getattr(errors, 'data', None) or []:
+                print(f"[ERROR] Batch {batch['batch_id']}: {error.code}: {error.message} (line {error.line})")
+            if remote_batch.error_file_id:
+                error_output = await client.files.content(remote_batch.error_file_id)
+                with open(batch['file'].replace('.jsonl', '.errors.jsonl'), 'w', encoding='utf-8') as f:
+                    f.write(error_output.text)
+                # The error lines have the format of the output lines, so the failed papers are reported one by one
+                store_results(error_output.text, args)
+
+            batch['status'] = remote_batch.status
+            save_state(state, args)
+            print(f"[INFO] Batch {batch['batch_id']} {remote_batch.status}: {success_count} of {len(batch['paper_ids'])} papers stored")
+
+        if any(i['status'] not in TERMINAL_STATUSES + ('prepared',) for i in state['batches']):
+            await asyncio.sleep(args.poll_interval)
+
+
+async def main(args):
+    # The base url defaults to OPENAI_BASE_URL, so a local stand-in server can be used for testing
+    if args.metrics_dir:
+        metrics.start(args.metrics_dir, args.metrics_interval)
+    http_client, http_async_client = metrics.get_http_clients()
+    client = AsyncOpenAI(base_url=args.base_url, http_client=http_async_client)
+    state = load_state(args)
+
+    # Finish the batches of the previous run first, so their failed papers can be queued again
+    if args.action == 'all':
+        await poll_batches(client, state, args)
+    if args.action in ('prepare', 'all'):
+        await prepare_batches(state, args)
+    if args.action in ('submit', 'all'):
+        await submit_batches(client, state, args)
+    if args.action in ('poll', 'all'):
+        await poll_batches(client, state, args)
+
+    if args.metrics_dir:
+        metrics.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--papers_mineru_dir', type=str, default='./export/papers_mineru', help='The path to the md directory')
+    parser.add_argument('--output_dir', type=str, default='./export/papers_info', help='The path to the output directory')
+    parser.add_argument('--batch_dir', type=str, default='./export/papers_info_batch', help='The path to the batch files and the batch state')
+    parser.add_argument('--model', type=str, default='gemini-2.5-flash-all', help='The model to use')
+    parser.add_argument('--base_url', type=str, default=None, help='The base url of the batch API, defaults to OPENAI_BASE_URL')
+    parser.add_argument('--action', type=str, default='all', choices=['prepare', 'submit', 'poll', 'all'], help='The step to run, resumes from the batch state')
+    parser.add_argument('--batch_max_requests', type=int, default=1000, help='The maximum number of papers in a batch file')
+    parser.add_argument('--batch_max_bytes', type=int, default=180 * 1024 * 1024, help='The maximum size of a batch file')
+    parser.add_argument('--completion_window', type=str, default='24h', help='The completion window of the batches')
+    parser.add_argument('--metrics_dir', type=str, default='./export/metrics/batch_paper_info', help='The path to write the metrics (json lines and prometheus text), empty to disable')
+    parser.add_argument('--metrics_interval', type=float, default=15.0, help='Interval (in seconds) between metrics writes')
+    parser.add_argument('--max_attempts', type=int, default=3, help='Number of finished batches a paper can fail in before it is no longer queued')
+    parser.add_argument('--poll_interval', type=float, default=60.0, help='Interval (in seconds) between polls')
+    args = parser.parse_args()
+
+    if not os.path.exists(args.papers_mineru_dir):
+        print(f'[ERROR] Papers mineru directory {args.papers_mineru_dir} does not exist')
+        exit(1)
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    os.makedirs(args.batch_dir, exist_ok=True)
+
+    asyncio.run(main(args))
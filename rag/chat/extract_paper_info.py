@@ -18,6 +18,8 @@ import numpy as np
 import sys, os
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from rag.embed.md_loader import get_paper_md
+from rag.lib.metrics import metrics
+from rag.lib.work_queue import WorkQueue, run_worker
 
 
 class HypothesisOrResearchQuestion(BaseModel):
@@ -39,15 +41,7 @@ class PaperInfo(BaseModel):
     content: List[HypothesisOrResearchQuestion] = Field(description="The content of the paper, which can be hypotheses or research questions.")
 
 
-async def chat(paper_id, text, args):
-    llm = ChatOpenAI(model=args.model, temperature=0)
-    
-    # Create output parser
-    parser = PydanticOutputParser(pydantic_object=PaperInfo)
-    format_instructions = parser.get_format_instructions()
-    
-    prompt = ChatPromptTemplate.from_messages([
-        ("system", """You're a PHD student in Information Systems.
+PAPER_SYSTEM_PROMPT = """You're a PHD student in Information Systems.
 
 # Goal
 Your task is to extract paper information from the transcript of the academic paper in the field of Information Systems. You will be given a transcript of the paper. You need to follow the guidelines and constraints to extract the information.
@@ -74,22 +68,81 @@ Your task is to extract paper information from the transcript of the academic pa
 # Output Format
 You will need to return the information in the following JSON format:
 {format_instructions}
-         """),
+         """
+
+
+SECTION_SYSTEM_PROMPT = """You're a PHD student in Information Systems.
+
+# Goal
+Your task is to extract paper information from ONE PART of the transcript of an academic paper in the field of Information Systems. The other parts of the paper are processed separately, so only use the text you are given.
+
+# Guidelines
+1. If this part states hypotheses or research questions, extract them, and find out the independent variable and dependent variable in each of them.
+2. If this part reports the method, result or conclusion of a hypothesis or research question, fill in these fields as well and repeat the hypothesis description so the parts can be matched later.
+3. Extract the keywords that appear in this part, and write a short summary of this part.
+
+- If the iv or dv is multiple, you need to extract them all, and separate them with commas.
+- If a field is not mentioned in this part, return an empty string for it.
+- If this part contains no hypotheses or research questions, return an empty content list.
+
+# Constraints
+1. Do not generate any other text or comments that are not included in the transcript.
+
+# Output Format
+You will need to return the information in the following JSON format:
+{format_instructions}
+         """
+
+
+REDUCE_SYSTEM_PROMPT = """You're a PHD student in Information Systems.
+
+# Goal
+You will be given the summaries of the consecutive parts of an academic paper. Write one summary of the whole paper, including the main contributions, methodology, and conclusions.
+
+# Constraints
+1. Do not generate any other text or comments that are not included in the summaries.
+2. Only return the summary text.
+         """
+
+
+def get_prompt(system_prompt=PAPER_SYSTEM_PROMPT):
+    """Get the extraction prompt and the format instructions of PaperInfo"""
+    # Create output parser
+    parser = PydanticOutputParser(pydantic_object=PaperInfo)
+    format_instructions = parser.get_format_instructions()
+    
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", system_prompt),
         ("human", "Below is the transcript of the paper:\n\n{text}"),
     ])
+    return prompt, format_instructions
+
+
+def get_llm(model):
+    """Get the chat model, which reports its API calls to the metrics"""
+    http_client, http_async_client = metrics.get_http_clients()
+    return ChatOpenAI(model=model, temperature=0, http_client=http_client, http_async_client=http_async_client)
+
+
+async def chat(paper_id, text, args, system_prompt=PAPER_SYSTEM_PROMPT):
+    llm = get_llm(args.model)
+    prompt, format_instructions = get_prompt(system_prompt)
     
-    chain = prompt | llm | StrOutputParser()
+    chain = prompt | llm
     
     try:
-        result = await chain.ainvoke({
-            "text": text,
-            "format_instructions": format_instructions
-        })
+        with metrics.timer('chat', stage_type='map' if system_prompt == SECTION_SYSTEM_PROMPT else 'paper'):
+            message = await chain.ainvoke({
+                "text": text,
+                "format_instructions": format_instructions
+            })
     except Exception as e:
+        metrics.inc('errors_total', stage='extract')
         print(f'[ERROR] Failed to extract the paper {paper_id}: {e}')
         return None
 
-    return result
+    metrics.record_chat_usage(args.model, message)
+    return StrOutputParser().invoke(message)
 
 
 async def get_the_main_content(paper_md):
@@ -106,33 +159,217 @@ async def get_the_main_content(paper_md):
     return paper_md
 
 
+def split_paper_sections(paper_md, max_chars):
+    """
+    Split the paper by its markdown headers, and pack consecutive sections into parts of at most max_chars.
+    A section longer than max_chars is split at paragraph boundaries, a paragraph longer than that is split
+    hard, and every piece of the section starts with its heading.
+    """
+    sections = [i for i in re.split(r'(?m)^(?=#+\s)', paper_md) if i.strip()]
+
+    pieces = []
+    for section in sections:
+        if len(section) <= max_chars:
+            pieces.append(section.strip())
+            continue
+        heading, body = '', section
+        if re.match(r'#+\s', section):
+            heading, _, body = section.partition('\n')
+            heading = f'{heading.strip()[:max_chars // 4]}\n\n'
+        limit = max_chars - len(heading)
+
+        paragraphs = []
+        for paragraph in body.split('\n\n'):
+            paragraph = paragraph.strip()
+            paragraphs.extend(i.strip() for i in (paragraph[j:j + limit] for j in range(0, len(paragraph), limit)) if i.strip())
+
+        piece = ''
+        for paragraph in paragraphs:
+            if piece and len(piece) + len(paragraph) + 2 > limit:
+                pieces.append(heading + piece)
+                piece = ''
+            piece = f'{piece}\n\n{paragraph}' if piece else paragraph
+        if piece:
+            pieces.append(heading + piece)
+
+    parts = []
+    part = ''
+    for piece in pieces:
+        if part and len(part) + len(piece) + 2 > max_chars:
+            parts.append(part)
+            part = ''
+        part = f'{part}\n\n{piece}' if part else piece
+    if part:
+        parts.append(part)
+
+    return parts
+
+
+def parse_paper_info(paper_id, result):
+    """Parse the raw LLM output into a dict, return None if it can not be parsed"""
+    if not result:
+        return None
+    try:
+        paper_info = json.loads(repair_json(result))
+    except Exception as e:
+        print(f"[ERROR] Failed to parse the paper info for paper {paper_id}: {e}")
+        return None
+    if not isinstance(paper_info, dict):
+        print(f"[ERROR] Unexpected paper info for paper {paper_id}: {type(paper_info).__name__}")
+        return None
+    return paper_info
+
+
+def merge_section_infos(section_infos):
+    """
+    Merge the section level extraction results into one paper info.
+    Hypotheses with the same description are merged, and the non-empty fields of the later parts
+    (e.g. method, result) fill in the empty fields of the earlier ones.
+    """
+    keywords = []
+    seen_keywords = set()
+    content = {}
+    for section_info in section_infos:
+        for keyword in section_info.get('keywords') or []:
+            if not isinstance(keyword, str) or keyword.strip().lower() in seen_keywords:
+                continue
+            seen_keywords.add(keyword.strip().lower())
+            keywords.append(keyword.strip())
+
+        for item in section_info.get('content') or []:
+            if not isinstance(item, dict) or not item.get('description'):
+                continue
+            key = re.sub(r'\W+', ' ', str(item['description'])).strip().lower()
+            if key not in content:
+                content[key] = {field: str(item.get(field) or '') for field in HypothesisOrResearchQuestion.model_fields}
+                continue
+            for field, value in item.items():
+                if field in content[key] and not content[key][field] and value:
+                    content[key][field] = str(value)
+
+    return {
+        'keywords': keywords,
+        'summary': '',
+        'content': list(content.values()),
+    }
+
+
+async def reduce_summaries(paper_id, summaries, args):
+    """Summarize the section summaries into the paper summary, fall back to joining them"""
+    summaries = [i for i in summaries if isinstance(i, str) and i.strip()]
+    if len(summaries) <= 1:
+        return summaries[0] if summaries else ''
+
+    model = args.reduce_model or args.model
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", REDUCE_SYSTEM_PROMPT),
+        ("human", "{summaries}"),
+    ])
+    chain = prompt | get_llm(model)
+    try:
+        with metrics.timer('chat', stage_type='reduce'):
+            message = await chain.ainvoke({
+                "summaries": '\n\n'.join(f'[Part {i + 1}]\n{summary}' for i, summary in enumerate(summaries)),
+            })
+    except Exception as e:
+        metrics.inc('errors_total', stage='extract')
+        print(f'[ERROR] Failed to reduce the summaries of the paper {paper_id}: {e}')
+        return ' '.join(summaries)
+
+    metrics.record_chat_usage(model, message)
+    return StrOutputParser().invoke(message)
+
+
+# The semaphore of the part requests of each event loop, shared by all the papers
+part_semaphores = {}
+
+
+def get_part_semaphore(part_concurrency):
+    loop = asyncio.get_running_loop()
+    if loop not in part_semaphores:
+        part_semaphores[loop] = asyncio.Semaphore(part_concurrency)
+    return part_semaphores[loop]
+
+
+async def chat_map_reduce(paper_id, text, args):
+    """
+    Extract the paper information part by part in parallel, then merge the results.
+    At most --part_concurrency part requests run at a time across all the papers.
+    A failed part is dropped instead of failing the whole paper.
+    """
+    parts = split_paper_sections(text, args.section_chars)
+    semaphore = get_part_semaphore(getattr(args, 'part_concurrency', 10))
+
+    async def chat_part(i, part):
+        async with semaphore:
+            return await chat(f'{paper_id}#{i}', part, args, system_prompt=SECTION_SYSTEM_PROMPT)
+
+    results = await asyncio.gather(*[chat_part(i, part) for i, part in enumerate(parts)])
+    section_infos = [parse_paper_info(f'{paper_id}#{i}', result) for i, result in enumerate(results)]
+    section_infos = [i for i in section_infos if i]
+
+    if not section_infos:
+        return None
+    paper_info = merge_section_infos(section_infos)
+    paper_info['summary'] = await reduce_summaries(paper_id, [i.get('summary') for i in section_infos], args)
+    if len(section_infos) < len(parts):
+        # Stored as a partial result, which is extracted again by the next run
+        print(f'[WARNING] Paper {paper_id}: {len(parts) - len(section_infos)} of {len(parts)} parts failed')
+        paper_info['failed_parts'] = len(parts) - len(section_infos)
+    return paper_info
+
+
+def is_extracted(paper_id, output_dir):
+    """Whether the paper info of a paper is stored, a partial result with failed parts does not count"""
+    output_path = os.path.join(output_dir, f'{paper_id}.json')
+    if not os.path.exists(output_path):
+        return False
+    try:
+        with open(output_path, 'r', encoding='utf-8') as f:
+            return not json.load(f).get('failed_parts')
+    except (OSError, ValueError, AttributeError):
+        return False
+
+
 async def process_paper_by_id(paper_id, args, semaphore, delay_seconds):
-    if os.path.exists(os.path.join(args.output_dir, f'{paper_id}.json')):
+    if is_extracted(paper_id, args.output_dir):
         return None
 
     await asyncio.sleep(delay_seconds)
+    metrics.add('queue_depth', 1, stage='extract')
     async with semaphore:
-        paper_md = get_paper_md(paper_id, args)
-        paper_md = await get_the_main_content(paper_md)
-        paper_info = await chat(paper_id, paper_md, args)
-
+        metrics.add('queue_depth', -1, stage='extract')
+        metrics.add('in_progress', 1, stage='extract')
         try:
-            if paper_info:
-                paper_info = repair_json(paper_info)
-                paper_info = json.loads(paper_info)
-        except Exception as e:
-            print(f"[ERROR] Failed to parse the paper info for paper {paper_id}: {e}")
-            await asyncio.sleep(3)
-            return None
-
-        if paper_info:
-            with open(os.path.join(args.output_dir, f'{paper_id}.json'), 'w', encoding='utf-8') as f:
-                json.dump(paper_info, f, indent=2)
+            paper_info = await _process_paper(paper_id, args)
+        finally:
+            metrics.add('in_progress', -1, stage='extract')
+    metrics.inc('papers_total', stage='extract', status='success' if paper_info else 'failed')
+    return paper_info
+
+
+async def _process_paper(paper_id, args):
+    """Extract and store the paper info of a single paper, inside the semaphore"""
+    paper_md = get_paper_md(paper_id, args)
+    paper_md = await get_the_main_content(paper_md)
+    if args.map_reduce and len(paper_md) > args.long_paper_chars:
+        paper_info = await chat_map_reduce(paper_id, paper_md, args)
+    else:
+        paper_info = parse_paper_info(paper_id, await chat(paper_id, paper_md, args))
+
+    if paper_info:
+        # Write then rename, so a worker crashing mid-write does not leave a truncated file that counts as done
+        output_path = os.path.join(args.output_dir, f'{paper_id}.json')
+        with open(f'{output_path}.tmp', 'w', encoding='utf-8') as f:
+            json.dump(paper_info, f, indent=2)
+        os.replace(f'{output_path}.tmp', output_path)
 
     return paper_info
 
 
 async def main():
+    if args.metrics_dir:
+        metrics.start(args.metrics_dir, args.metrics_interval)
     semaphore = asyncio.Semaphore(10)
 
     paper_ids = [i for i in os.listdir(args.papers_mineru_dir) if os.path.isdir(os.path.join(args.papers_mineru_dir, i))]
@@ -146,7 +383,42 @@ async def main():
         tasks = [process_paper_by_id(paper_id, args, semaphore, delay_seconds[i]) for i, paper_id in enumerate(batch_paper_ids)]
         await tqdm_asyncio.gather(*tasks, desc="Processing papers", unit="paper")
 
-    
+    if args.metrics_dir:
+        metrics.stop()
+
+
+
+def enqueue():
+    """Add an extraction job for every paper folder without paper info to the work queue"""
+    paper_ids = [i for i in os.listdir(args.papers_mineru_dir) if os.path.isdir(os.path.join(args.papers_mineru_dir, i))]
+    paper_ids = [i for i in sorted(paper_ids) if not is_extracted(i, args.output_dir)]
+    queue = WorkQueue(args.queue_db, 'extract', args.lease_seconds)
+    print(f"[INFO] Enqueued {queue.enqueue(paper_ids, args.priority)} of {len(paper_ids)} papers")
+    print(f"[INFO] Queue extract: {queue.stats()}")
+
+
+async def worker():
+    """Extract the paper info of the papers claimed from the work queue, any number of workers can run at the same time"""
+    if args.metrics_dir:
+        metrics.start(args.metrics_dir, args.metrics_interval)
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def handle(paper_id):
+        await process_paper_by_id(paper_id, args, semaphore, 0)
+        if is_extracted(paper_id, args.output_dir):
+            return True, None
+        # A partial result is kept, and the job is retried for the failed parts
+        if os.path.exists(os.path.join(args.output_dir, f'{paper_id}.json')):
+            return False, 'some parts failed'
+        return False, 'no paper info extracted'
+
+    queue = WorkQueue(args.queue_db, 'extract', args.lease_seconds)
+    await run_worker(queue, handle, args.concurrency, args.poll_interval)
+
+    if args.metrics_dir:
+        metrics.stop()
+
+
 async def dev():
     semaphore = asyncio.Semaphore(1)
     paper_info = await process_paper_by_id(10, args, semaphore, 0)
@@ -162,12 +434,30 @@ if __name__ == '__main__':
     parser.add_argument('--output_dir', type=str, default='./export/papers_info', help='The path to the output directory')
     parser.add_argument('--db_path', type=str, default='./export/db/academy.db', help='The path to the database file')
     parser.add_argument('--model', type=str, default='gemini-2.5-flash-all', help='The model to use')
+    parser.add_argument('--map_reduce', action='store_true', help='Extract long papers section by section in parallel, then merge the results')
+    parser.add_argument('--long_paper_chars', type=int, default=60000, help='Papers longer than this (in characters) use the map-reduce mode')
+    parser.add_argument('--section_chars', type=int, default=12000, help='The maximum size (in characters) of a part in the map-reduce mode')
+    parser.add_argument('--reduce_model', type=str, default=None, help='The model to merge the part summaries, defaults to --model')
+    parser.add_argument('--part_concurrency', type=int, default=10, help='Maximum number of concurrent part requests in the map-reduce mode, across all the papers')
+    parser.add_argument('--metrics_dir', type=str, default='./export/metrics/extract_paper_info', help='The path to write the metrics (json lines and prometheus text), empty to disable')
+    parser.add_argument('--metrics_interval', type=float, default=15.0, help='Interval (in seconds) between metrics writes')
     parser.add_argument('--dev', action='store_true', help='Run in development mode')
+    parser.add_argument('--enqueue', action='store_true', help='Add the papers to the work queue instead of processing them')
+    parser.add_argument('--worker', action='store_true', help='Process the papers claimed from the work queue')
+    parser.add_argument('--queue_db', type=str, default='./export/db/queue.db', help='The path to the work queue database, shared by the workers')
+    parser.add_argument('--lease_seconds', type=float, default=300.0, help='Seconds before the job of a silent worker is claimed again')
+    parser.add_argument('--priority', type=int, default=0, help='Priority of the enqueued jobs, higher is claimed first')
+    parser.add_argument('--concurrency', type=int, default=10, help='Number of papers a worker processes concurrently')
+    parser.add_argument('--poll_interval', type=float, default=0.0, help='Seconds between polls of an empty queue, 0 to stop the worker when the queue is drained')
     args = parser.parse_args()
     
     os.makedirs(args.output_dir, exist_ok=True)
     
     if args.dev:
         asyncio.run(dev())
+    elif args.enqueue:
+        enqueue()
+    elif args.worker:
+        asyncio.run(worker())
     else:
         asyncio.run(main())
\ No newline at end of file
@@ -12,6 +12,8 @@ from tqdm.asyncio import tqdm_asyncio
 import argparse
 import asyncio
 import json
+import os
+import re
 
 def get_paper_header_structure(paper_docs):
     header_structure = []
@@ -75,9 +77,185 @@ Your task is to add a markdown header prefix to the headers in the list, and dec
     return json.loads(result)
     
 
+# A dotted number ("3.1", "3.1.") or a number with a trailing dot ("3."), or a bare number before a capitalized word
+# as in Springer and Elsevier ("1 Introduction"), the space can be missing before a capitalized word ("1.Introduction")
+HEADER_NUMBER_PATTERN = re.compile(
+    r'^(?:(\d{1,2}(?:\.\d{1,2})+)\.?|(\d{1,2})\.)(?:\s+(?=\S)|(?=[A-Z]))'
+    r'|^(\d{1,2})\s+(?=[A-Z])'
+)
+
+
+def collapse_spaced_letters(header):
+    """Collapse letter-spaced headers, e.g. "A B S T R A C T" -> "ABSTRACT" """
+    return re.sub(r'\b(?:[A-Za-z] ){2,}[A-Za-z]\b', lambda m: m.group(0).replace(' ', ''), header)
+
+
+def get_header_key(header):
+    """Get the lookup key of a header in the header map, which ignores spacing, numbering and case"""
+    header = collapse_spaced_letters(header.strip().lstrip('#').strip())
+    header = HEADER_NUMBER_PATTERN.sub('', header)
+    return re.sub(r'\s+', ' ', header).strip(' .:').lower()
+
+
+def to_sentence_case(title):
+    """Convert a header to sentence case, keeping the acronyms, e.g. "Search Affordances and IT Use" -> "Search affordances and IT use" """
+    if title.isupper():
+        title = title.lower()
+    words = [word if sum(c.isupper() for c in word) > 1 or any(c.isdigit() for c in word) else word.lower() for word in title.split(' ')]
+    if words and words[0].islower():
+        words[0] = words[0][:1].upper() + words[0][1:]
+    return ' '.join(words)
+
+
+def rule_normalize_header(header):
+    """
+    Normalize a numbered header by rules, the level is the depth of the numbering (at most 3).
+    Return None for the headers without numbering or with multiple numbered headers in one item.
+    """
+    header = collapse_spaced_letters(header.strip().lstrip('#').strip())
+    match = HEADER_NUMBER_PATTERN.match(header)
+    if not match:
+        return None
+    title = re.sub(r'\s+', ' ', header[match.end():]).strip(' .:')
+    if not title or re.search(r'\s\d+(?:\.\d+)+\.?\s', f' {title} '):
+        return None
+    level = min((match.group(1) or match.group(2) or match.group(3)).count('.') + 1, 3)
+    # The same sentence case as the headers normalized by the LLM
+    return f"{'#' * level} {to_sentence_case(title)}"
+
+
+def load_header_map(header_map_path):
+    """Load the learned header map, which maps a header key to its markdown header (None if it is not a header)"""
+    if not os.path.exists(header_map_path):
+        return {}
+    with open(header_map_path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_header_map(header_map, header_map_path):
+    os.makedirs(os.path.dirname(os.path.abspath(header_map_path)), exist_ok=True)
+    with open(f'{header_map_path}.tmp', 'w', encoding='utf-8') as f:
+        json.dump(header_map, f, ensure_ascii=False, indent=2, sort_keys=True)
+    os.replace(f'{header_map_path}.tmp', header_map_path)
+
+
+async def learn_unseen_headers(headers, header_map, batch_size=200):
+    """
+    Send the unseen headers of many papers to the LLM in batches, and store the answers into the header map.
+    The headers come from different papers, so the LLM decides the level from the typical structure of a paper.
+    """
+    llm = ChatOpenAI(model="gpt-4o-mini", temperature=0)
+    prompt = ChatPromptTemplate.from_messages([
+        ("system", """
+# Goal
+Your task is to add a markdown header prefix to the headers in the list.
+
+You're providing with a list of unique headers extracted from many academic papers by a pdf loader. Most headers have no numbering, so decide the level of each header from the typical structure of an academic paper. If a header has numbering, decide the level from the depth of the numbering (e.g. "3.1." is level 2) and drop the numbering. The maximum level of the header is 3. (e.g. "#" "##" or "###").
+
+# Constraints
+- First, you should decide whether the header is a header or not. If it is not a header (e.g. a journal name, an author name or a sentence), then just return an empty string for it.
+- Second, you should decide the level of the header. The maximum level of the header is 3. (e.g. "#" "##" or "###").
+- Third, you need to convert the header string in a unified format. The capitalization of the header should be consistent with the SENTENCE CASE.
+- If there are multiple headers in the same item, then you should convert them to the same item but with different levels. For example, "3. Empirical Analysis 3.1. Data" -> "# Empirical analysis ## Data"
+
+# Few shot examples
+"A B S T R A C T" -> "# Abstract"
+"Introduction" -> "# Introduction"
+"Information Systems Research" -> ""
+"Research Question" -> "## Research question"
+
+# Response format
+- The response should be a json list of headers in markdown format.
+- The number of headers should be consistent with the original.
+        """),
+        ("user", "{headers}"),
+    ])
+    chain = prompt | llm | StrOutputParser()
+
+    for i in range(0, len(headers), batch_size):
+        batch_headers = headers[i:i + batch_size]
+        try:
+            result = await chain.ainvoke({
+                "headers": json.dumps(batch_headers, ensure_ascii=False)
+            })
+            result = json.loads(json_repair.repair_json(result))
+        except Exception as e:
+            print(f'[ERROR] Failed to normalize {len(batch_headers)} headers: {e}')
+            continue
+
+        if not isinstance(result, list) or len(result) != len(batch_headers):
+            print(f'[ERROR] Expected {len(batch_headers)} headers, got {len(result) if isinstance(result, list) else type(result).__name__}')
+            continue
+        for header, normalized_header in zip(batch_headers, result):
+            normalized_header = str(normalized_header).strip()
+            header_map[get_header_key(header)] = normalized_header if normalized_header.startswith('#') else None
+
+
+def resolve_header(header, header_map):
+    """Resolve a header by rules and the header map, return None if it has not been seen"""
+    if not header.strip():
+        return ''
+    normalized_header = rule_normalize_header(header)
+    if normalized_header is not None:
+        return normalized_header
+    key = get_header_key(header)
+    if key not in header_map:
+        return None
+    # Not a header, keep the original string
+    return header if header_map[key] is None else header_map[key]
+
+
+async def normalize_header_structures(header_structures, header_map, batch_size=200):
+    """
+    Normalize the header structures of many papers at once.
+    Only the headers that can not be resolved by rules or the header map are sent to the LLM, deduplicated across papers.
+    """
+    unseen_headers = {}
+    for header_structure in header_structures.values():
+        for header in header_structure:
+            if resolve_header(header, header_map) is None:
+                unseen_headers.setdefault(get_header_key(header), header)
+
+    if unseen_headers:
+        print(f'[INFO] Sending {len(unseen_headers)} unseen headers to the LLM')
+        await learn_unseen_headers(list(unseen_headers.values()), header_map, batch_size)
+
+    normalized_structures = {}
+    for paper_id, header_structure in header_structures.items():
+        normalized_structure = []
+        for header in header_structure:
+            normalized_header = resolve_header(header, header_map)
+            normalized_structure.append(header if normalized_header is None else normalized_header)
+        normalized_structures[paper_id] = normalized_structure
+    return normalized_structures
+
+
 async def main(args):
     import sys, os
     sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+    from rag.embed.md_loader import get_paper_docs
+    paper_ids = [i for i in os.listdir(args.papers_mineru_dir) if os.path.isdir(os.path.join(args.papers_mineru_dir, i))]
+    paper_ids = sorted(paper_ids)
+
+    header_map = load_header_map(args.header_map)
+    print(f'[INFO] Loaded {len(header_map)} known headers')
+
+    normalized_structures = {}
+    for batch_idx in range(0, len(paper_ids), args.papers_per_batch):
+        batch_paper_ids = paper_ids[batch_idx:batch_idx + args.papers_per_batch]
+        header_structures = {paper_id: get_paper_header_structure(get_paper_docs(paper_id, args)) for paper_id in batch_paper_ids}
+        normalized_structures.update(await normalize_header_structures(header_structures, header_map, args.llm_batch_size))
+        save_header_map(header_map, args.header_map)
+        print(f'[INFO] Processed {min(batch_idx + args.papers_per_batch, len(paper_ids))} of {len(paper_ids)} papers, {len(header_map)} known headers')
+
+    with open(args.output_path, 'w', encoding='utf-8') as f:
+        json.dump(normalized_structures, f, ensure_ascii=False, indent=2)
+
+
+async def dev(args):
+    import sys, os
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
     
     from rag.embed.md_loader import get_paper_docs
     paper_docs = get_paper_docs(10, args)
@@ -96,7 +274,15 @@ if __name__ == '__main__':
     args = argparse.ArgumentParser()
     args.add_argument('--papers_mineru_dir', type=str, default='./export/papers_mineru', help='The path to the md directory')
     args.add_argument('--db_path', type=str, default='./export/db/academy.db', help='The path to the database file')
+    args.add_argument('--header_map', type=str, default='./export/header_map.json', help='The path to the learned header map')
+    args.add_argument('--output_path', type=str, default='./export/papers_headers.json', help='The path to the normalized header structures')
+    args.add_argument('--papers_per_batch', type=int, default=1000, help='Number of papers whose unseen headers share the LLM calls')
+    args.add_argument('--llm_batch_size', type=int, default=200, help='Number of unseen headers in each LLM call')
+    args.add_argument('--dev', action='store_true', help='Use dev mode')
     args = args.parse_args()
 
 
-    asyncio.run(main(args))
\ No newline at end of file
+    if args.dev:
+        asyncio.run(dev(args))
+    else:
+        asyncio.run(main(args))
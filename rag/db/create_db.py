@@ -32,35 +32,100 @@ def create_db(args):
         )
     ''')
     conn.commit()
+    create_indexes(conn)
+    create_fts(conn)
     conn.close()
 
 
+def create_indexes(conn):
+    """Index the columns used to look up papers, so the lookups are not full table scans"""
+    conn.executescript('''
+        CREATE INDEX IF NOT EXISTS idx_paper_title ON paper (title);
+        CREATE INDEX IF NOT EXISTS idx_paper_doi ON paper (doi);
+    ''')
+    conn.commit()
+
+
+def create_fts(conn):
+    """
+    Create the FTS5 full-text indexes: paper_fts over the title, authors and journal of the paper table,
+    and section_fts over the section-level markdown of the converted papers kept in paper_section.
+    Both index external content and are kept in sync by triggers.
+    """
+    exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'paper_fts'").fetchone() is not None
+    conn.executescript('''
+        CREATE VIRTUAL TABLE IF NOT EXISTS paper_fts USING fts5(
+            title, authors, journal,
+            content='paper', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        );
+        CREATE TRIGGER IF NOT EXISTS paper_fts_insert AFTER INSERT ON paper BEGIN
+            INSERT INTO paper_fts (rowid, title, authors, journal) VALUES (new.id, new.title, new.authors, new.journal);
+        END;
+        CREATE TRIGGER IF NOT EXISTS paper_fts_delete AFTER DELETE ON paper BEGIN
+            INSERT INTO paper_fts (paper_fts, rowid, title, authors, journal) VALUES ('delete', old.id, old.title, old.authors, old.journal);
+        END;
+        CREATE TRIGGER IF NOT EXISTS paper_fts_update AFTER UPDATE OF id, title, authors, journal ON paper BEGIN
+            INSERT INTO paper_fts (paper_fts, rowid, title, authors, journal) VALUES ('delete', old.id, old.title, old.authors, old.journal);
+            INSERT INTO paper_fts (rowid, title, authors, journal) VALUES (new.id, new.title, new.authors, new.journal);
+        END;
+        CREATE TABLE IF NOT EXISTS paper_section (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            paper_id INTEGER,
+            section TEXT,
+            text TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_paper_section_paper_id ON paper_section (paper_id);
+        CREATE VIRTUAL TABLE IF NOT EXISTS section_fts USING fts5(
+            section, text,
+            content='paper_section', content_rowid='id', tokenize='unicode61 remove_diacritics 2', prefix='2 3'
+        );
+        CREATE TRIGGER IF NOT EXISTS section_fts_insert AFTER INSERT ON paper_section BEGIN
+            INSERT INTO section_fts (rowid, section, text) VALUES (new.id, new.section, new.text);
+        END;
+        CREATE TRIGGER IF NOT EXISTS section_fts_delete AFTER DELETE ON paper_section BEGIN
+            INSERT INTO section_fts (section_fts, rowid, section, text) VALUES ('delete', old.id, old.section, old.text);
+        END;
+        CREATE TABLE IF NOT EXISTS section_fts_source (
+            paper_id INTEGER PRIMARY KEY,
+            md_hash TEXT
+        );
+    ''')
+    # Index the papers inserted before the full-text index existed
+    if not exists:
+        conn.execute("INSERT INTO paper_fts (paper_fts) VALUES ('rebuild')")
+    conn.commit()
+
+
 def insert_paper(args, paper_info: PaperInfo):
+    """Insert a paper, return its id, or the id of the paper with the same title or DOI if it already exists"""
     try:
         conn = sqlite3.connect(args.db_path)
         # 通过文献标题查询文献是否存在
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT * FROM paper WHERE title = ?
+            SELECT id FROM paper WHERE title = ?
         ''', (paper_info.title,))
-        if cursor.fetchone() is not None:
+        row = cursor.fetchone()
+        if row is not None:
             print(f'Title {paper_info.title} already exists')
-            return
+            return row[0]
         
         # 通过文献 DOI 查询文献是否存在
         cursor = conn.cursor()
         cursor.execute('''
-            SELECT * FROM paper WHERE doi = ?
+            SELECT id FROM paper WHERE doi = ?
         ''', (paper_info.doi,))
-        if cursor.fetchone() is not None:
+        row = cursor.fetchone()
+        if row is not None:
             print(f'DOI {paper_info.doi} already exists')
-            return
+            return row[0]
         
         # 插入文献信息
         cursor.execute('''
             INSERT INTO paper (title, doi, year, authors, journal, file_exists) VALUES (?, ?, ?, ?, ?, ?)
         ''', (paper_info.title, paper_info.doi, paper_info.year, paper_info.authors, paper_info.journal, paper_info.file_exists))
         conn.commit()
+        return cursor.lastrowid
     except Exception as e:
         print(f'[ERROR] {e}')
     finally:
@@ -3,8 +3,14 @@ import sqlite3
 import shutil
 import argparse
 
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag.db.create_db import create_indexes
+
 def main(args):
     conn = sqlite3.connect(args.db_path)
+    # The title lookups below use the index instead of scanning the table
+    create_indexes(conn)
     cursor = conn.cursor()
 
     for pdf_dir in args.pdf_dirs:
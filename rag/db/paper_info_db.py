@@ -0,0 +1,194 @@
+import os
+import json
+import sqlite3
+import argparse
+import pandas as pd
+from tqdm import tqdm
+
+
+HYPOTHESIS_FIELDS = ['type', 'description', 'iv', 'iv_description', 'dv', 'dv_description', 'method', 'result', 'conclusion']
+
+
+def create_paper_info_tables(conn):
+    """Create the tables of the extracted paper info, flattened from PaperInfo and HypothesisOrResearchQuestion"""
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS paper_info (
+            paper_id INTEGER PRIMARY KEY,
+            summary TEXT,
+            source_mtime INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS paper_keyword (
+            paper_id INTEGER,
+            keyword TEXT COLLATE NOCASE
+        );
+        CREATE TABLE IF NOT EXISTS paper_hypothesis (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            paper_id INTEGER,
+            idx INTEGER,
+            type TEXT,
+            description TEXT,
+            iv TEXT,
+            iv_description TEXT,
+            dv TEXT,
+            dv_description TEXT,
+            method TEXT,
+            result TEXT,
+            conclusion TEXT
+        );
+        CREATE INDEX IF NOT EXISTS idx_paper_keyword_keyword ON paper_keyword (keyword);
+        CREATE INDEX IF NOT EXISTS idx_paper_keyword_paper_id ON paper_keyword (paper_id);
+        CREATE INDEX IF NOT EXISTS idx_paper_hypothesis_paper_id ON paper_hypothesis (paper_id);
+        CREATE INDEX IF NOT EXISTS idx_paper_hypothesis_type ON paper_hypothesis (type);
+    ''')
+    conn.commit()
+
+
+def delete_paper_info(conn, paper_id):
+    conn.execute('DELETE FROM paper_info WHERE paper_id = ?', (paper_id,))
+    conn.execute('DELETE FROM paper_keyword WHERE paper_id = ?', (paper_id,))
+    conn.execute('DELETE FROM paper_hypothesis WHERE paper_id = ?', (paper_id,))
+
+
+def insert_paper_info(conn, paper_id, paper_info, source_mtime):
+    """Replace the rows of a paper with its extracted paper info"""
+    delete_paper_info(conn, paper_id)
+    conn.execute('''
+        INSERT INTO paper_info (paper_id, summary, source_mtime) VALUES (?, ?, ?)
+    ''', (paper_id, str(paper_info.get('summary') or ''), source_mtime))
+    conn.executemany('''
+        INSERT INTO paper_keyword (paper_id, keyword) VALUES (?, ?)
+    ''', [(paper_id, str(keyword)) for keyword in paper_info.get('keywords') or []])
+    conn.executemany(f'''
+        INSERT INTO paper_hypothesis (paper_id, idx, {', '.join(HYPOTHESIS_FIELDS)}) VALUES (?, ?, {', '.join('?' * len(HYPOTHESIS_FIELDS))})
+    ''', [
+        (paper_id, idx, *[str(item.get(field) or '') for field in HYPOTHESIS_FIELDS])
+        for idx, item in enumerate(paper_info.get('content') or []) if isinstance(item, dict)
+    ])
+
+
+def sync_paper_info(args):
+    """
+    Incrementally sync the json files in the papers info directory into the database.
+    Only the files whose modification time changed are parsed again, and the rows of deleted files are removed.
+    """
+    conn = sqlite3.connect(args.db_path)
+    create_paper_info_tables(conn)
+    stored = dict(conn.execute('SELECT paper_id, source_mtime FROM paper_info').fetchall())
+
+    files = {}
+    for file in os.listdir(args.papers_info_dir):
+        if file.endswith('.json') and file[:-len('.json')].isdigit():
+            files[int(file[:-len('.json')])] = os.stat(os.path.join(args.papers_info_dir, file)).st_mtime_ns
+
+    changed = [paper_id for paper_id, mtime in files.items() if stored.get(paper_id) != mtime]
+    removed = [paper_id for paper_id in stored if paper_id not in files]
+
+    updated_count = 0
+    try:
+        for paper_id in tqdm(changed, desc="Syncing paper info", unit="paper"):
+            try:
+                with open(os.path.join(args.papers_info_dir, f'{paper_id}.json'), 'r', encoding='utf-8') as f:
+                    paper_info = json.load(f)
+            except Exception as e:
+                print(f'[ERROR] Failed to read the paper info of paper {paper_id}: {e}')
+                continue
+            if not isinstance(paper_info, dict):
+                print(f'[ERROR] The paper info of paper {paper_id} is not an object, skipped')
+                continue
+            insert_paper_info(conn, paper_id, paper_info, files[paper_id])
+            updated_count += 1
+            if updated_count % 500 == 0:
+                conn.commit()
+        for paper_id in removed:
+            delete_paper_info(conn, paper_id)
+        conn.commit()
+    finally:
+        conn.close()
+
+    print(f'[INFO] Updated: {updated_count}, Removed: {len(removed)}, Unchanged: {len(files) - len(changed)}')
+
+
+def query_hypotheses(db_path, iv=None, dv=None, keyword=None, type=None, year_range=None, limit=None):
+    """
+    Query the hypotheses or research questions over the whole corpus.
+    iv and dv are case-insensitive substrings, keyword matches a paper keyword exactly (case-insensitive),
+    and year_range is an inclusive (min_year, max_year) tuple on the paper table.
+    """
+    conditions, params = [], []
+    if iv:
+        conditions.append("h.iv LIKE ?")
+        params.append(f'%{iv}%')
+    if dv:
+        conditions.append("h.dv LIKE ?")
+        params.append(f'%{dv}%')
+    if type:
+        conditions.append("h.type = ?")
+        params.append(type)
+    if keyword:
+        conditions.append("h.paper_id IN (SELECT paper_id FROM paper_keyword WHERE keyword = ?)")
+        params.append(keyword)
+    if year_range:
+        conditions.append("p.year BETWEEN ? AND ?")
+        params.extend(year_range)
+
+    sql = f'''
+        SELECT h.paper_id, p.title, p.year, p.journal, {', '.join(f'h.{field}' for field in HYPOTHESIS_FIELDS)}
+        FROM paper_hypothesis h LEFT JOIN paper p ON p.id = h.paper_id
+        {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ORDER BY h.paper_id, h.idx
+    '''
+    if limit:
+        sql += ' LIMIT ?'
+        params.append(limit)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        return pd.read_sql_query(sql, conn, params=params)
+    finally:
+        conn.close()
+
+
+def export_parquet(args):
+    """Export the paper info tables into parquet files for analysis"""
+    os.makedirs(args.parquet_dir, exist_ok=True)
+    conn = sqlite3.connect(args.db_path)
+    try:
+        for table in ['paper_info', 'paper_keyword', 'paper_hypothesis']:
+            df = pd.read_sql_query(f'SELECT * FROM {table}', conn)
+            df.to_parquet(os.path.join(args.parquet_dir, f'{table}.parquet'), index=False)
+            print(f'[INFO] Exported {len(df)} rows of {table}')
+    finally:
+        conn.close()
+
+
+def main(args):
+    if args.sync:
+        sync_paper_info(args)
+    if args.parquet_dir:
+        export_parquet(args)
+    if args.iv or args.dv or args.keyword:
+        df = query_hypotheses(args.db_path, iv=args.iv, dv=args.dv, keyword=args.keyword, limit=args.limit)
+        print(df[['paper_id', 'title', 'year', 'iv', 'dv']].to_string())
+        print(f'Total hypotheses: {len(df)}')
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--db_path', type=str, default='./export/db/academy.db', help='The path to the database file')
+    args.add_argument('--papers_info_dir', type=str, default='./export/papers_info', help='The path to the papers info directory')
+    args.add_argument('--parquet_dir', type=str, default=None, help='Export the paper info tables into this directory as parquet')
+    args.add_argument('--sync', action='store_true', help='Sync the papers info directory into the database')
+    args.add_argument('--iv', type=str, default=None, help='Query the hypotheses whose iv contains this text')
+    args.add_argument('--dv', type=str, default=None, help='Query the hypotheses whose dv contains this text')
+    args.add_argument('--keyword', type=str, default=None, help='Query the hypotheses of the papers with this keyword')
+    args.add_argument('--limit', type=int, default=100, help='The maximum number of hypotheses to print')
+    args = args.parse_args()
+
+    if not os.path.exists(args.db_path):
+        print(f'[ERROR] Database file {args.db_path} does not exist')
+        exit(1)
+    if args.sync and not os.path.exists(args.papers_info_dir):
+        print(f'[ERROR] Papers info directory {args.papers_info_dir} does not exist')
+        exit(1)
+
+    main(args)
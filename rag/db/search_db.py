@@ -0,0 +1,175 @@
+import os
+import re
+import hashlib
+import sqlite3
+import argparse
+from tqdm import tqdm
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag.db.create_db import create_indexes, create_fts
+
+
+def split_sections(paper_md):
+    """Split the paper markdown into (section, text) by its headers"""
+    sections = []
+    for part in re.split(r'(?m)^(?=#+\s)', paper_md):
+        if not part.strip():
+            continue
+        header, _, text = part.partition('\n')
+        if header.startswith('#'):
+            sections.append((header.lstrip('#').strip(), text.strip()))
+        else:
+            sections.append(('', part.strip()))
+    return sections
+
+
+def index_paper_sections(conn, paper_id, paper_md):
+    """Index the sections of a converted paper, return False if its markdown has not changed"""
+    md_hash = hashlib.sha1(paper_md.encode('utf-8')).hexdigest()
+    stored = conn.execute('SELECT md_hash FROM section_fts_source WHERE paper_id = ?', (paper_id,)).fetchone()
+    if stored is not None and stored[0] == md_hash:
+        return False
+
+    # The sections are deleted by the paper_id index, and the triggers delete them from section_fts by rowid
+    if stored is not None:
+        conn.execute('DELETE FROM paper_section WHERE paper_id = ?', (paper_id,))
+    conn.executemany('''
+        INSERT INTO paper_section (paper_id, section, text) VALUES (?, ?, ?)
+    ''', [(paper_id, section, text) for section, text in split_sections(paper_md)])
+    conn.execute('INSERT OR REPLACE INTO section_fts_source (paper_id, md_hash) VALUES (?, ?)', (paper_id, md_hash))
+    return True
+
+
+def index_paper_md(db_path, paper_id, paper_md_path):
+    """Index one converted paper, used right after its conversion"""
+    if not os.path.exists(paper_md_path):
+        return
+    with open(paper_md_path, 'r', encoding='utf-8') as f:
+        paper_md = f.read()
+    conn = sqlite3.connect(db_path)
+    try:
+        create_fts(conn)
+        index_paper_sections(conn, int(paper_id), paper_md)
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def sync_sections(args):
+    """Index the sections of all converted papers whose markdown changed"""
+    conn = sqlite3.connect(args.db_path)
+    create_indexes(conn)
+    create_fts(conn)
+
+    paper_ids = [i for i in os.listdir(args.papers_mineru_dir) if i.isdigit() and os.path.isdir(os.path.join(args.papers_mineru_dir, i))]
+    indexed_count = 0
+    try:
+        for paper_id in tqdm(paper_ids, desc="Indexing sections", unit="paper"):
+            paper_md_path = os.path.join(args.papers_mineru_dir, paper_id, 'txt', f'{paper_id}.md')
+            if not os.path.exists(paper_md_path):
+                continue
+            with open(paper_md_path, 'r', encoding='utf-8') as f:
+                indexed_count += index_paper_sections(conn, int(paper_id), f.read())
+            if indexed_count and indexed_count % 500 == 0:
+                conn.commit()
+        conn.commit()
+    finally:
+        conn.close()
+    print(f'[INFO] Indexed {indexed_count} papers, {len(paper_ids) - indexed_count} unchanged or missing')
+
+
+def quote(term):
+    """Quote a term as an FTS5 string, so its punctuation is not parsed as query syntax"""
+    return '"' + term.replace('"', '""') + '"'
+
+
+def prefix_query(text):
+    """Every word of the text must match, the last one as a prefix, e.g. "mobile chan" -> "mobile" "chan"*"""
+    words = text.split()
+    if not words:
+        return '""'
+    return ' '.join([quote(i) for i in words[:-1]] + [quote(words[-1]) + '*'])
+
+
+def phrase_query(phrase):
+    return quote(phrase)
+
+
+def near_query(terms, distance=10):
+    """All the terms within distance tokens of each other"""
+    return f"NEAR({' '.join(quote(i) for i in terms)}, {distance})"
+
+
+def search(db_path, match, table='paper', column=None, limit=20):
+    """
+    Run a full-text query, return (paper_id, title, snippet) ranked by bm25.
+    table is 'paper' (title, authors, journal) or 'section' (section markdown), column restricts the match to one column.
+    """
+    if column:
+        match = f'{column} : ({match})'
+    if table == 'paper':
+        sql = '''
+            SELECT rowid, title, snippet(paper_fts, -1, '[', ']', '...', 12)
+            FROM paper_fts WHERE paper_fts MATCH ? ORDER BY rank LIMIT ?
+        '''
+    else:
+        sql = '''
+            SELECT s.paper_id, p.title, snippet(section_fts, 1, '[', ']', '...', 16)
+            FROM section_fts JOIN paper_section s ON s.id = section_fts.rowid LEFT JOIN paper p ON p.id = s.paper_id
+            WHERE section_fts MATCH ? ORDER BY section_fts.rank LIMIT ?
+        '''
+    conn = sqlite3.connect(db_path)
+    try:
+        return conn.execute(sql, (match, limit)).fetchall()
+    finally:
+        conn.close()
+
+
+def search_prefix(db_path, text, table='paper', column=None, limit=20):
+    return search(db_path, prefix_query(text), table, column, limit)
+
+
+def search_phrase(db_path, phrase, table='section', column=None, limit=20):
+    return search(db_path, phrase_query(phrase), table, column, limit)
+
+
+def search_near(db_path, terms, distance=10, table='section', column=None, limit=20):
+    return search(db_path, near_query(terms, distance), table, column, limit)
+
+
+def main(args):
+    if args.sync:
+        sync_sections(args)
+
+    if args.prefix:
+        results = search_prefix(args.db_path, args.prefix, args.table, limit=args.limit)
+    elif args.phrase:
+        results = search_phrase(args.db_path, args.phrase, args.table, limit=args.limit)
+    elif args.near:
+        results = search_near(args.db_path, args.near, args.distance, args.table, limit=args.limit)
+    else:
+        return
+    for paper_id, title, snippet in results:
+        print(f'* [{paper_id}] {title}')
+        print(f'  {snippet}')
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--db_path', type=str, default='./export/db/academy.db', help='The path to the database file')
+    args.add_argument('--papers_mineru_dir', type=str, default='./export/papers_mineru', help='The path to the papers mineru directory')
+    args.add_argument('--sync', action='store_true', help='Index the sections of the converted papers')
+    args.add_argument('--table', type=str, default='paper', choices=['paper', 'section'], help='Search the paper metadata or the paper sections')
+    args.add_argument('--prefix', type=str, default=None, help='Search the words, the last one as a prefix')
+    args.add_argument('--phrase', type=str, default=None, help='Search an exact phrase')
+    args.add_argument('--near', type=str, nargs='+', default=None, help='Search the words near each other')
+    args.add_argument('--distance', type=int, default=10, help='The maximum distance (in tokens) of the near search')
+    args.add_argument('--limit', type=int, default=20, help='The maximum number of results')
+    args = args.parse_args()
+
+    if not os.path.exists(args.db_path):
+        print(f'[ERROR] Database file {args.db_path} does not exist')
+        exit(1)
+
+    main(args)
@@ -5,8 +5,11 @@ import asyncio
 import argparse
 import os
 import random
+import threading
+import time
 import numpy as np
 from langchain_chroma import Chroma
+from langchain_core.embeddings import Embeddings
 from langchain_openai import OpenAIEmbeddings
 from tqdm.asyncio import tqdm
 
@@ -14,41 +17,130 @@ import os, sys
 sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 print(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
 from rag.embed.md_loader import get_paper_docs, get_paper_docs_recursive
+from rag.embed.dedup_docs import ChunkDeduplicator
+from rag.embed.shards import SHARD_BY, ShardedVectorStore
+from rag.lib.metrics import metrics
+from rag.lib.work_queue import WorkQueue, run_worker
 
 
-async def handle_one_paper(paper_id, vectorstore, semaphore, args, delay_time=0):
+class MeteredEmbeddings(Embeddings):
+    """Wrap an embedding model to time the embedding calls, the tokens are counted from the API responses by the metrics http clients"""
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        self.seconds = 0.0
+        self.local = threading.local()
+
+    @property
+    def thread_seconds(self):
+        """The time spent in the embedding model by the current thread"""
+        return getattr(self.local, 'seconds', 0.0)
+
+    def embed_documents(self, texts):
+        start = time.perf_counter()
+        try:
+            embeddings = self.embeddings.embed_documents(texts)
+        finally:
+            elapsed = time.perf_counter() - start
+            self.seconds += elapsed
+            self.local.seconds = self.thread_seconds + elapsed
+            metrics.observe('stage_seconds', elapsed, stage='embed')
+        return embeddings
+
+    def embed_query(self, text):
+        with metrics.timer('embed_query'):
+            return self.embeddings.embed_query(text)
+
+
+def get_embeddings():
+    """Get the embedding model, which reports its API calls and tokens to the metrics"""
+    http_client, http_async_client = metrics.get_http_clients()
+    embeddings = OpenAIEmbeddings(
+        model=os.environ['EMBEDDING_MODEL'],
+        dimensions=1024,
+        http_client=http_client,
+        http_async_client=http_async_client,
+    )
+    return MeteredEmbeddings(embeddings)
+
+
+def get_vectorstore(args, embeddings, collection_name=None):
+    """Get the collection, or the sharded collections if --shard_by is set"""
+    if args.shard_by != 'none':
+        return ShardedVectorStore(
+            embedding_function=embeddings,
+            persist_directory=args.chroma_dir,
+            collection_name=collection_name or args.collection_name,
+            shard_by=args.shard_by,
+            year_bucket=args.year_bucket,
+        )
+    return Chroma(
+        embedding_function=embeddings,
+        persist_directory=args.chroma_dir,
+        collection_name=collection_name or args.collection_name,
+    )
+
+
+def add_paper_documents(vectorstore, paper_docs):
+    """Add the documents of a paper in batches, the time not spent in the embedding model is the Chroma write"""
+    for i in range(0, len(paper_docs), 64):
+        start, embed_seconds = time.perf_counter(), getattr(vectorstore.embeddings, 'thread_seconds', 0.0)
+        vectorstore.add_documents(paper_docs[i:min(i + 64, len(paper_docs))])
+        embed_seconds = getattr(vectorstore.embeddings, 'thread_seconds', 0.0) - embed_seconds
+        metrics.observe('stage_seconds', time.perf_counter() - start - embed_seconds, stage='chroma_write')
+
+
+async def handle_one_paper(paper_id, vectorstore, semaphore, args, delay_time=0, deduplicator=None):
     """Process the embedding task of a single paper"""
+    metrics.add('queue_depth', 1, stage='embed')
     async with semaphore:
-        if await is_paper_exists(paper_id, vectorstore):
-            return {"paper_id": paper_id, "status": "skipped", "reason": "already_exists", "count": 0}
-
+        metrics.add('queue_depth', -1, stage='embed')
+        metrics.add('in_progress', 1, stage='embed')
         try:
-            await asyncio.sleep(delay_time)
-            
-            # Get paper documents
+            return await _handle_one_paper(paper_id, vectorstore, args, delay_time, deduplicator)
+        finally:
+            metrics.add('in_progress', -1, stage='embed')
+
+
+async def _handle_one_paper(paper_id, vectorstore, args, delay_time=0, deduplicator=None):
+    """The embedding task of a single paper, inside the semaphore"""
+    with metrics.timer('is_paper_exists'):
+        paper_exists = await is_paper_exists(paper_id, vectorstore)
+    if paper_exists:
+        return {"paper_id": paper_id, "status": "skipped", "reason": "already_exists", "count": 0}
+
+    try:
+        await asyncio.sleep(delay_time)
+        
+        # Get paper documents
+        with metrics.timer('chunk'):
             if args.recursive:
                 paper_docs = get_paper_docs_recursive(paper_id, args)
             else:
                 paper_docs = get_paper_docs(paper_id, args)
+        
+        # Drop boilerplate, reference lists and near-duplicate chunks before paying for their embeddings
+        if deduplicator is not None:
+            with metrics.timer('dedup'):
+                paper_docs = deduplicator.filter(paper_docs)
+
+        if not paper_docs:
+            return {"paper_id": paper_id, "status": "skipped", "reason": "no_docs", "count": 0}
+        
+        # Add documents to vectorstore in a worker thread, so the papers in the semaphore embed in parallel
+        await asyncio.to_thread(add_paper_documents, vectorstore, paper_docs)
+        metrics.inc('chunks_total', len(paper_docs), stage='embed')
+        
+        if await is_paper_exists(paper_id, vectorstore):
+            return {"paper_id": paper_id, "status": "success", "reason": "added", "count": len(paper_docs)}
+        else:
+            return {"paper_id": paper_id, "status": "failed", "reason": "verification_failed", "count": 0}
             
-            if not paper_docs:
-                return {"paper_id": paper_id, "status": "skipped", "reason": "no_docs", "count": 0}
-            
-            # Add documents to vectorstore
-            for i in range(0, len(paper_docs), 64):
-                vectorstore.add_documents(paper_docs[i:min(i + 64, len(paper_docs))])
-            
-            if await is_paper_exists(paper_id, vectorstore):
-                return {"paper_id": paper_id, "status": "success", "reason": "added", "count": len(paper_docs)}
-            else:
-                return {"paper_id": paper_id, "status": "failed", "reason": "verification_failed", "count": 0}
-                
-        except Exception as e:
-            print(f"[ERROR] Error processing paper {paper_id}: {e}")
-            return {"paper_id": paper_id, "status": "error", "reason": str(e), "count": 0}
+    except Exception as e:
+        print(f"[ERROR] Error processing paper {paper_id}: {e}")
+        return {"paper_id": paper_id, "status": "error", "reason": str(e), "count": 0}
 
 
-async def process_batch(batch_papers, vectorstore, semaphore, args, batch_num):
+async def process_batch(batch_papers, vectorstore, semaphore, args, batch_num, deduplicator=None):
     """Process a batch of papers"""
     batch_size = len(batch_papers)
     # Generate exponential distribution delay times for the current batch
@@ -58,7 +150,7 @@ async def process_batch(batch_papers, vectorstore, semaphore, args, batch_num):
     
     # Create tasks for the current batch
     tasks = [
-        handle_one_paper(paper_id, vectorstore, semaphore, args, delay_time) 
+        handle_one_paper(paper_id, vectorstore, semaphore, args, delay_time, deduplicator) 
         for paper_id, delay_time in zip(batch_papers, delay_times)
     ]
     
@@ -66,6 +158,7 @@ async def process_batch(batch_papers, vectorstore, semaphore, args, batch_num):
     batch_results = []
     for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc=f"Batch {batch_num}"):
         result = await task
+        metrics.inc('papers_total', stage='embed', status=result['status'])
         batch_results.append(result)
     
     return batch_results
@@ -73,18 +166,17 @@ async def process_batch(batch_papers, vectorstore, semaphore, args, batch_num):
 
 async def is_paper_exists(paper_id, vectorstore):
     """Check if the paper already exists in the vectorstore"""
-    docs = vectorstore.similarity_search(query=f"hello_world", k=1, filter={"paper_id": paper_id})
-    return len(docs) > 0
+    # A metadata lookup, which does not embed a query
+    docs = vectorstore.get(where={"paper_id": paper_id}, limit=1, include=[])
+    return len(docs['ids']) > 0
 
 
 async def main(args):
     """Main function to process all papers' embedding tasks in batch"""
-    embeddings = OpenAIEmbeddings(model=os.environ['EMBEDDING_MODEL'], dimensions=1024)
-    vectorstore = Chroma(
-        embedding_function=embeddings,
-        persist_directory=args.chroma_dir,
-        collection_name=args.collection_name,
-    )
+    if args.metrics_dir:
+        metrics.start(args.metrics_dir, args.metrics_interval)
+    embeddings = get_embeddings()
+    vectorstore = get_vectorstore(args, embeddings)
 
     # Get all paper ids
     paper_ids = [str(i) for i in os.listdir(args.papers_mineru_dir) if os.path.isdir(os.path.join(args.papers_mineru_dir, i))]
@@ -101,12 +193,16 @@ async def main(args):
     
     # Create semaphore to control concurrency
     semaphore = asyncio.Semaphore(10)
+
+    deduplicator = ChunkDeduplicator.load(args.dedup_index) if args.dedup else None
     
     # Process all batches
     all_results = []
     for batch_num, batch_papers in enumerate(batches, 1):
-        batch_results = await process_batch(batch_papers, vectorstore, semaphore, args, batch_num)
+        batch_results = await process_batch(batch_papers, vectorstore, semaphore, args, batch_num, deduplicator)
         all_results.extend(batch_results)
+        if deduplicator is not None:
+            deduplicator.save_every(args.dedup_index, args.dedup_save_interval)
         
         # Interval between batches
         if batch_num < len(batches):
@@ -126,6 +222,10 @@ async def main(args):
     print(f"[INFO] Error: {error_count}")
     print(f"[INFO] Skipped: {skipped_count}")
     print(f"[INFO] Total processed documents: {total_docs}")
+    if deduplicator is not None:
+        if args.dedup_index:
+            deduplicator.save(args.dedup_index)
+        deduplicator.report()
     
     # Output error details
     if error_count > 0:
@@ -134,15 +234,41 @@ async def main(args):
             if result["status"] == "error":
                 print(f"  Paper {result['paper_id']}: {result['reason']}")
 
+    if args.metrics_dir:
+        metrics.stop()
+
+
+def enqueue(args):
+    """Add an embedding job for every paper folder to the work queue"""
+    paper_ids = [str(i) for i in os.listdir(args.papers_mineru_dir) if os.path.isdir(os.path.join(args.papers_mineru_dir, i))]
+    queue = WorkQueue(args.queue_db, 'embed', args.lease_seconds)
+    print(f"[INFO] Enqueued {queue.enqueue(paper_ids, args.priority)} of {len(paper_ids)} papers")
+    print(f"[INFO] Queue embed: {queue.stats()}")
+
+
+async def worker(args):
+    """Embed the papers claimed from the work queue, any number of workers can run at the same time"""
+    if args.metrics_dir:
+        metrics.start(args.metrics_dir, args.metrics_interval)
+    vectorstore = get_vectorstore(args, get_embeddings())
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def handle(paper_id):
+        result = await handle_one_paper(paper_id, vectorstore, semaphore, args, 0)
+        metrics.inc('papers_total', stage='embed', status=result['status'])
+        return result['status'] in ('success', 'skipped'), result['reason']
+
+    queue = WorkQueue(args.queue_db, 'embed', args.lease_seconds)
+    await run_worker(queue, handle, args.concurrency, args.poll_interval)
+
+    if args.metrics_dir:
+        metrics.stop()
+
 
 async def dev(args):
     """Development mode: test the processing of a single paper"""
-    embeddings = OpenAIEmbeddings(model=os.environ['EMBEDDING_MODEL'], dimensions=1024)
-    vectorstore = Chroma(
-        embedding_function=embeddings,
-        persist_directory=args.chroma_dir,
-        collection_name='test',
-    )
+    embeddings = get_embeddings()
+    vectorstore = get_vectorstore(args, embeddings, collection_name='test')
 
     paper_id = "10"  # Use string format to keep consistent
 
@@ -169,17 +295,39 @@ if __name__ == '__main__':
     args.add_argument('--db_path', type=str, default='./export/db/academy.db', help='The path to the database file')
     args.add_argument('--dev', action='store_true', help='Use dev mode')
     args.add_argument('--recursive', action='store_true', help='Use recursive mode')
+    args.add_argument('--shard_by', type=str, default='none', choices=SHARD_BY, help='Split the collection into shards by year bucket or journal')
+    args.add_argument('--year_bucket', type=int, default=5, help='Number of years in a year shard')
+    args.add_argument('--dedup', action='store_true', help='Filter boilerplate, reference lists and near-duplicate chunks before embedding')
+    args.add_argument('--dedup_index', type=str, default='./export/chroma/dedup_index.pkl', help='The path to persist the dedup index across runs')
+    args.add_argument('--dedup_save_interval', type=float, default=1800.0, help='Interval (in seconds) between saves of the dedup index, which is also saved at the end')
+    args.add_argument('--metrics_dir', type=str, default='./export/metrics/create_embed', help='The path to write the metrics (json lines and prometheus text), empty to disable')
+    args.add_argument('--metrics_interval', type=float, default=15.0, help='Interval (in seconds) between metrics writes')
     args.add_argument('--batch_size', type=int, default=100, help='Number of papers to process in each batch')
     args.add_argument('--batch_interval', type=float, default=10.0, help='Interval (in seconds) between batches')
+    args.add_argument('--enqueue', action='store_true', help='Add the papers to the work queue instead of processing them')
+    args.add_argument('--worker', action='store_true', help='Process the papers claimed from the work queue')
+    args.add_argument('--queue_db', type=str, default='./export/db/queue.db', help='The path to the work queue database, shared by the workers')
+    args.add_argument('--lease_seconds', type=float, default=300.0, help='Seconds before the job of a silent worker is claimed again')
+    args.add_argument('--priority', type=int, default=0, help='Priority of the enqueued jobs, higher is claimed first')
+    args.add_argument('--concurrency', type=int, default=10, help='Number of papers a worker processes concurrently')
+    args.add_argument('--poll_interval', type=float, default=0.0, help='Seconds between polls of an empty queue, 0 to stop the worker when the queue is drained')
     args = args.parse_args()
     
     if not os.path.exists(args.papers_mineru_dir):
         print(f'[ERROR] Papers mineru directory {args.papers_mineru_dir} does not exist')
         exit(1)
     
+    if args.worker and args.dedup:
+        print('[ERROR] --dedup can not be used with --worker, as each worker would keep its own dedup index')
+        exit(1)
+
     os.makedirs(args.chroma_dir, exist_ok=True)
     
     if args.dev:
         asyncio.run(dev(args))
+    elif args.enqueue:
+        enqueue(args)
+    elif args.worker:
+        asyncio.run(worker(args))
     else:
         asyncio.run(main(args))
\ No newline at end of file
@@ -0,0 +1,232 @@
+import argparse
+import os
+import re
+import pickle
+import time
+import zlib
+import numpy as np
+from tqdm import tqdm
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag.embed.md_loader import get_paper_docs, get_paper_docs_recursive
+
+
+# Lines of publisher boilerplate, which are removed from the chunks
+BOILERPLATE_PATTERNS = [
+    r'downloaded from\b',
+    r'this article was downloaded by',
+    r'all rights reserved',
+    r'^\s*(?:©|\(c\)|copyright\b)',
+    r'terms (?:and|&) conditions',
+    r'for personal use only',
+    r'^\s*(?:doi|https?)\s*[:/]',
+    r'^\s*isbn\b|^\s*issn\b',
+]
+BOILERPLATE_PATTERN = re.compile('|'.join(BOILERPLATE_PATTERNS), re.IGNORECASE)
+IMAGE_PATTERN = re.compile(r'!\[[^\]]*\]\([^)]*\)')
+CITATION_PATTERN = re.compile(r'\(?(?:19|20)\d{2}[a-z]?\)?[.,;:]')
+# Below 2^31, so the signatures fit in uint32 and the hashing does not overflow uint64
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def estimate_tokens(text):
+    """Roughly estimate the number of tokens of a text (about 4 characters per token)"""
+    return len(text) // 4 + 1
+
+
+def is_image_only(text):
+    return not IMAGE_PATTERN.sub('', text).strip()
+
+
+def is_reference_list(doc):
+    """A chunk is a reference list if it is in the references section or most of its lines are citations"""
+    if doc.metadata.get('section') == 'Reference':
+        return True
+    lines = [i for i in doc.page_content.splitlines() if i.strip()]
+    if len(lines) < 3:
+        return False
+    citation_lines = sum(1 for line in lines if CITATION_PATTERN.search(line))
+    return citation_lines / len(lines) >= 0.6
+
+
+def strip_boilerplate(text):
+    return '\n'.join(line for line in text.splitlines() if not BOILERPLATE_PATTERN.search(line)).strip()
+
+
+class ChunkDeduplicator:
+    """
+    Filter the chunks of the corpus before embedding.
+    Boilerplate lines are stripped, reference lists and image-only chunks are dropped, and near-duplicate
+    chunks across the corpus are collapsed into the first one seen with MinHash/LSH over word shingles.
+    """
+    def __init__(self, num_perm=128, bands=32, threshold=0.8, shingle_size=5, min_chars=50, seed=1):
+        assert num_perm % bands == 0, 'num_perm should be divisible by bands'
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.min_chars = min_chars
+
+        random_state = np.random.RandomState(seed)
+        self.a = random_state.randint(1, 1 << 31, size=num_perm).astype(np.uint64)
+        self.b = random_state.randint(0, 1 << 31, size=num_perm).astype(np.uint64)
+        self.band_multipliers = random_state.randint(1, 1 << 62, size=self.rows, dtype=np.int64).astype(np.uint64)
+
+        # The band hash -> index of the first signature with it, for each band
+        self.buckets = [{} for _ in range(bands)]
+        # The signatures in one preallocated array, grown by doubling, of which the first size rows are used
+        self.size = 0
+        self.signatures = np.zeros((1024, num_perm), dtype=np.uint32)
+        # The paper and call of each signature, so a paper filtered again (e.g. a retry) is not a duplicate of itself
+        self.owner_papers = np.zeros(1024, dtype=np.int64)
+        self.owner_calls = np.zeros(1024, dtype=np.int64)
+        self.paper_codes = {}
+        self.calls = 0
+        self.last_save = time.monotonic()
+        self.stats = {
+            'total_vectors': 0, 'total_tokens': 0,
+            'removed_vectors': {}, 'removed_tokens': 0,
+        }
+
+    def get_signature(self, text):
+        """Get the MinHash signature of the word shingles of a text"""
+        words = re.findall(r'\w+', text.lower())
+        shingles = {' '.join(words[i:i + self.shingle_size]) for i in range(max(len(words) - self.shingle_size + 1, 1))}
+        hashes = np.fromiter((zlib.crc32(i.encode('utf-8')) for i in shingles), dtype=np.uint64, count=len(shingles))
+        return ((hashes[:, None] * self.a + self.b) % MERSENNE_PRIME).min(axis=0).astype(np.uint32)
+
+    def append(self, signature, paper_code, call):
+        if self.size == len(self.signatures):
+            self.signatures = np.concatenate([self.signatures, np.zeros_like(self.signatures)])
+            self.owner_papers = np.concatenate([self.owner_papers, np.zeros_like(self.owner_papers)])
+            self.owner_calls = np.concatenate([self.owner_calls, np.zeros_like(self.owner_calls)])
+        self.signatures[self.size] = signature
+        self.owner_papers[self.size] = paper_code
+        self.owner_calls[self.size] = call
+        self.size += 1
+        return self.size - 1
+
+    def is_near_duplicate(self, signature, owner):
+        """Check the signature against the LSH buckets, and add it to the buckets if it is new"""
+        paper_code = self.paper_codes.setdefault(owner[0], len(self.paper_codes))
+        band_keys = (signature.reshape(self.bands, self.rows).astype(np.uint64) * self.band_multipliers).sum(axis=1).tolist()
+        candidates = {self.buckets[i][key] for i, key in enumerate(band_keys) if key in self.buckets[i]}
+        for candidate in candidates:
+            if self.owner_papers[candidate] == paper_code and self.owner_calls[candidate] != owner[1]:
+                continue
+            if np.mean(self.signatures[candidate] == signature) >= self.threshold:
+                return True
+
+        index = self.append(signature, paper_code, owner[1])
+        for i, key in enumerate(band_keys):
+            self.buckets[i].setdefault(key, index)
+        return False
+
+    def remove(self, reason, tokens):
+        self.stats['removed_vectors'][reason] = self.stats['removed_vectors'].get(reason, 0) + 1
+        self.stats['removed_tokens'] += tokens
+
+    def filter(self, docs):
+        """Filter the chunks of a paper, return the chunks to embed"""
+        kept_docs = []
+        self.calls += 1
+        for doc in docs:
+            tokens = estimate_tokens(doc.page_content)
+            self.stats['total_vectors'] += 1
+            self.stats['total_tokens'] += tokens
+
+            if is_image_only(doc.page_content):
+                self.remove('image_only', tokens)
+                continue
+            if is_reference_list(doc):
+                self.remove('reference', tokens)
+                continue
+
+            text = strip_boilerplate(doc.page_content)
+            if len(IMAGE_PATTERN.sub('', text).strip()) < self.min_chars:
+                self.remove('boilerplate' if text != doc.page_content.strip() else 'too_short', tokens)
+                continue
+            if self.is_near_duplicate(self.get_signature(text), (doc.metadata.get('paper_id'), self.calls)):
+                self.remove('near_duplicate', tokens)
+                continue
+
+            self.stats['removed_tokens'] += tokens - estimate_tokens(text)
+            doc.page_content = text
+            kept_docs.append(doc)
+        return kept_docs
+
+    def report(self):
+        total_vectors = max(self.stats['total_vectors'], 1)
+        total_tokens = max(self.stats['total_tokens'], 1)
+        removed_vectors = sum(self.stats['removed_vectors'].values())
+        print(f"[INFO] Dedup removed {removed_vectors} of {self.stats['total_vectors']} vectors ({removed_vectors / total_vectors:.1%})")
+        print(f"[INFO] Dedup removed {self.stats['removed_tokens']} of {self.stats['total_tokens']} tokens ({self.stats['removed_tokens'] / total_tokens:.1%})")
+        for reason, count in sorted(self.stats['removed_vectors'].items()):
+            print(f"[INFO]   {reason}: {count}")
+
+    def __getstate__(self):
+        # Only the used rows of the signature arrays are saved
+        state = self.__dict__.copy()
+        state['signatures'] = self.signatures[:self.size]
+        state['owner_papers'] = self.owner_papers[:self.size]
+        state['owner_calls'] = self.owner_calls[:self.size]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        capacity = max(1024, 2 * self.size)
+        for name in ['signatures', 'owner_papers', 'owner_calls']:
+            array = state[name]
+            grown = np.zeros((capacity, *array.shape[1:]), dtype=array.dtype)
+            grown[:self.size] = array
+            setattr(self, name, grown)
+        self.last_save = time.monotonic()
+
+    def save(self, path):
+        with open(f'{path}.tmp', 'wb') as f:
+            pickle.dump(self, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(f'{path}.tmp', path)
+        self.last_save = time.monotonic()
+
+    def save_every(self, path, interval):
+        """Save the index if the last save was more than interval seconds ago, to bound the work lost to a crash"""
+        if path and time.monotonic() - self.last_save >= interval:
+            self.save(path)
+
+    @staticmethod
+    def load(path, **kwargs):
+        """Load the deduplicator of the previous runs, so chunks already embedded are still seen"""
+        if path and os.path.exists(path):
+            with open(path, 'rb') as f:
+                return pickle.load(f)
+        return ChunkDeduplicator(**kwargs)
+
+
+def main(args):
+    """Report the share of the corpus that would be removed, without embedding anything"""
+    deduplicator = ChunkDeduplicator(threshold=args.threshold)
+    paper_ids = [i for i in os.listdir(args.papers_mineru_dir) if os.path.isdir(os.path.join(args.papers_mineru_dir, i))]
+    for paper_id in tqdm(sorted(paper_ids)):
+        if args.recursive:
+            paper_docs = get_paper_docs_recursive(paper_id, args)
+        else:
+            paper_docs = get_paper_docs(paper_id, args)
+        deduplicator.filter(paper_docs)
+    deduplicator.report()
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--papers_mineru_dir', type=str, default='./export/papers_mineru', help='The path to the papers mineru directory')
+    args.add_argument('--db_path', type=str, default='./export/db/academy.db', help='The path to the database file')
+    args.add_argument('--recursive', action='store_true', help='Use recursive mode')
+    args.add_argument('--threshold', type=float, default=0.8, help='The estimated Jaccard similarity above which chunks are near-duplicates')
+    args = args.parse_args()
+
+    if not os.path.exists(args.papers_mineru_dir):
+        print(f'[ERROR] Papers mineru directory {args.papers_mineru_dir} does not exist')
+        exit(1)
+
+    main(args)
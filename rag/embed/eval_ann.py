@@ -0,0 +1,254 @@
+from dotenv import load_dotenv, find_dotenv
+_ = load_dotenv(find_dotenv())
+
+import argparse
+import json
+import os
+import random
+import time
+import chromadb
+import faiss
+import numpy as np
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
+
+def get_collections(client, collection_name):
+    """Get the collection and its shards ({collection_name}__{shard}), whichever exist"""
+    names = [getattr(i, 'name', i) for i in client.list_collections()]
+    names = [i for i in names if i == collection_name or i.startswith(f'{collection_name}__')]
+    return [client.get_collection(i) for i in sorted(names)]
+
+
+def load_vectors(collections, page_size=5000):
+    """Load the ids, documents and embeddings of all the chunks of the collections"""
+    ids, documents, embeddings = [], [], []
+    for collection in collections:
+        for offset in range(0, collection.count(), page_size):
+            result = collection.get(include=['documents', 'embeddings'], limit=page_size, offset=offset)
+            ids.extend(result['ids'])
+            documents.extend(result['documents'])
+            embeddings.extend(result['embeddings'])
+    return ids, documents, np.asarray(embeddings, dtype=np.float32)
+
+
+def get_metric(collections):
+    """The distance of the collections, Chroma uses squared l2 by default"""
+    metadata = (collections[0].metadata or {}) if collections else {}
+    return metadata.get('hnsw:space', 'l2')
+
+
+def sample_queries(args, ids, vectors):
+    """
+    Sample the query vectors, as (query_ids, query_vectors).
+    Chunk queries are stored chunks, whose own id is excluded from their results; hypothesis queries are
+    the hypotheses and research questions in papers_info, embedded with the embedding model.
+    """
+    rng = random.Random(args.seed)
+    if args.query_source == 'chunk':
+        indexes = rng.sample(range(len(ids)), min(args.num_queries, len(ids)))
+        return [ids[i] for i in indexes], vectors[indexes]
+
+    texts = []
+    for file_name in sorted(os.listdir(args.papers_info_dir)):
+        if not file_name.endswith('.json'):
+            continue
+        with open(os.path.join(args.papers_info_dir, file_name), 'r', encoding='utf-8') as f:
+            paper_info = json.load(f)
+        texts.extend(i['description'] for i in paper_info.get('content') or [] if isinstance(i, dict) and i.get('description'))
+    texts = rng.sample(texts, min(args.num_queries, len(texts)))
+
+    from rag.embed.create_embed import get_embeddings
+    query_vectors = np.asarray(get_embeddings().embed_documents(texts), dtype=np.float32)
+    return [None] * len(texts), query_vectors
+
+
+def search_exact(vectors, queries, k, metric, batch_size=256):
+    """The exact top-k of the queries by brute force, in batches of queries"""
+    if metric == 'cosine':
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    vector_norms = (vectors ** 2).sum(axis=1)
+    results = []
+    for i in range(0, len(queries), batch_size):
+        batch = queries[i:i + batch_size]
+        if metric == 'l2':
+            distances = vector_norms[None, :] - 2 * batch @ vectors.T
+        else:
+            distances = -batch @ vectors.T
+        top = np.argpartition(distances, min(k, len(vectors) - 1), axis=1)[:, :k]
+        order = np.take_along_axis(distances, top, axis=1).argsort(axis=1)
+        results.extend(np.take_along_axis(top, order, axis=1))
+    return np.asarray(results)
+
+
+def get_ground_truth(ids, vectors, query_ids, query_vectors, k, metric):
+    """The ids of the exact top-k of each query, without the query chunk itself"""
+    neighbors = search_exact(vectors, query_vectors, k + 1, metric)
+    return [[ids[j] for j in row if ids[j] != query_id][:k] for query_id, row in zip(query_ids, neighbors)]
+
+
+def get_faiss_configs(args, n):
+    """The faiss index configurations and their search parameters to evaluate"""
+    nlist = args.nlist or max(1, int(4 * np.sqrt(n)))
+    configs = [('Flat', {}, [{}])]
+    for m in args.hnsw_m:
+        configs.append((f'HNSW{m}', {'m': m}, [{'efSearch': i} for i in args.ef_search]))
+    configs.append((f'IVF{nlist},Flat', {'nlist': nlist}, [{'nprobe': i} for i in args.nprobe if i <= nlist]))
+    return configs
+
+
+def build_faiss_index(name, params, vectors, metric):
+    dimension = vectors.shape[1]
+    faiss_metric = faiss.METRIC_L2 if metric == 'l2' else faiss.METRIC_INNER_PRODUCT
+    if name == 'Flat':
+        index = faiss.IndexFlat(dimension, faiss_metric)
+    elif name.startswith('HNSW'):
+        index = faiss.IndexHNSWFlat(dimension, params['m'], faiss_metric)
+    else:
+        index = faiss.IndexIVFFlat(faiss.IndexFlat(dimension, faiss_metric), dimension, params['nlist'], faiss_metric)
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+def set_search_params(index, search_params):
+    if 'efSearch' in search_params:
+        index.hnsw.efSearch = search_params['efSearch']
+    if 'nprobe' in search_params:
+        index.nprobe = search_params['nprobe']
+
+
+def evaluate(search_fn, query_ids, query_vectors, ground_truth, k):
+    """
+    Run the queries one at a time, as in serving, and measure the recall@k, the MRR of the exact
+    nearest neighbor and the latency percentiles. search_fn(vector, n) returns the ids of the top n.
+    """
+    recalls, reciprocal_ranks, latencies = [], [], []
+    for query_id, vector, truth in zip(query_ids, query_vectors, ground_truth):
+        start = time.perf_counter()
+        result = search_fn(vector, k + (query_id is not None))
+        latencies.append(time.perf_counter() - start)
+        result = [i for i in result if i != query_id][:k]
+        recalls.append(len(set(result) & set(truth)) / max(len(truth), 1))
+        reciprocal_ranks.append(1 / (result.index(truth[0]) + 1) if truth and truth[0] in result else 0.0)
+    return {
+        'recall': float(np.mean(recalls)),
+        'mrr': float(np.mean(reciprocal_ranks)),
+        'p50_ms': float(np.percentile(latencies, 50) * 1000),
+        'p95_ms': float(np.percentile(latencies, 95) * 1000),
+    }
+
+
+def evaluate_faiss(args, ids, vectors, query_ids, query_vectors, ground_truth, metric):
+    if metric == 'cosine':
+        vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        query_vectors = query_vectors / np.maximum(np.linalg.norm(query_vectors, axis=1, keepdims=True), 1e-12)
+    faiss.omp_set_num_threads(args.threads)
+
+    results = []
+    for name, params, search_params_list in get_faiss_configs(args, len(vectors)):
+        start = time.perf_counter()
+        index = build_faiss_index(name, params, vectors, metric)
+        build_seconds = time.perf_counter() - start
+        memory_mb = faiss.serialize_index(index).nbytes / 1e6
+        for search_params in search_params_list:
+            set_search_params(index, search_params)
+
+            def search_fn(vector, n):
+                _, neighbors = index.search(vector[None, :], n)
+                return [ids[i] for i in neighbors[0] if i >= 0]
+
+            result = evaluate(search_fn, query_ids, query_vectors, ground_truth, args.k)
+            results.append({'index': f'faiss {name}', 'params': search_params, 'build_s': build_seconds, 'memory_mb': memory_mb, **result})
+            print(f"[INFO] faiss {name} {search_params}: recall@{args.k} {result['recall']:.4f}, p95 {result['p95_ms']:.2f} ms")
+    return results
+
+
+def evaluate_chroma(collections, query_ids, query_vectors, ground_truth, k):
+    """The collection as it is served, the shards are queried one after another and merged"""
+    def search_fn(vector, n):
+        hits = []
+        for collection in collections:
+            result = collection.query(query_embeddings=[vector.tolist()], n_results=n, include=['distances'])
+            hits.extend(zip(result['distances'][0], result['ids'][0]))
+        return [doc_id for _, doc_id in sorted(hits)[:n]]
+
+    result = evaluate(search_fn, query_ids, query_vectors, ground_truth, k)
+    print(f"[INFO] chroma: recall@{k} {result['recall']:.4f}, p95 {result['p95_ms']:.2f} ms")
+    return [{'index': 'chroma', 'params': {}, 'build_s': None, 'memory_mb': None, **result}]
+
+
+def get_pareto(results):
+    """The results that no other result beats in both recall and p95 latency"""
+    return [
+        i for i in results
+        if not any(j['recall'] >= i['recall'] and j['p95_ms'] <= i['p95_ms'] and (j['recall'] > i['recall'] or j['p95_ms'] < i['p95_ms']) for j in results)
+    ]
+
+
+def print_table(results, k):
+    pareto = [id(i) for i in get_pareto(results)]
+    print(f"{'':2}{'index':<24}{'params':<18}{f'recall@{k}':>10}{'mrr':>8}{'p50 ms':>9}{'p95 ms':>9}{'memory MB':>11}{'build s':>9}")
+    for i in sorted(results, key=lambda i: (-i['recall'], i['p95_ms'])):
+        params = ','.join(f'{key}={value}' for key, value in i['params'].items())
+        memory = f"{i['memory_mb']:.1f}" if i['memory_mb'] is not None else '-'
+        build = f"{i['build_s']:.1f}" if i['build_s'] is not None else '-'
+        print(f"{'*' if id(i) in pareto else '':2}{i['index']:<24}{params:<18}{i['recall']:>10.4f}{i['mrr']:>8.4f}{i['p50_ms']:>9.2f}{i['p95_ms']:>9.2f}{memory:>11}{build:>9}")
+    print('* on the recall / p95 latency Pareto front')
+
+
+def main(args):
+    client = chromadb.PersistentClient(path=args.chroma_dir)
+    collections = get_collections(client, args.collection_name)
+    if not collections:
+        print(f'[ERROR] Collection {args.collection_name} does not exist')
+        exit(1)
+    metric = get_metric(collections)
+
+    ids, _, vectors = load_vectors(collections)
+    if args.max_vectors and len(ids) > args.max_vectors:
+        indexes = sorted(random.Random(args.seed).sample(range(len(ids)), args.max_vectors))
+        ids, vectors = [ids[i] for i in indexes], vectors[indexes]
+    print(f'[INFO] Loaded {len(ids)} vectors of dimension {vectors.shape[1]} from {len(collections)} collections, metric {metric}')
+
+    query_ids, query_vectors = sample_queries(args, ids, vectors)
+    start = time.perf_counter()
+    ground_truth = get_ground_truth(ids, vectors, query_ids, query_vectors, args.k, metric)
+    print(f'[INFO] Exact top-{args.k} of {len(query_ids)} {args.query_source} queries in {time.perf_counter() - start:.1f} s')
+
+    results = evaluate_faiss(args, ids, vectors, query_ids, query_vectors, ground_truth, metric)
+    if not args.max_vectors or len(ids) == sum(i.count() for i in collections):
+        results += evaluate_chroma(collections, query_ids, query_vectors, ground_truth, args.k)
+
+    print_table(results, args.k)
+    if args.output:
+        with open(args.output, 'a', encoding='utf-8') as f:
+            f.write(json.dumps({'timestamp': time.time(), 'collection': args.collection_name, 'vectors': len(ids),
+                                'queries': len(query_ids), 'query_source': args.query_source, 'k': args.k, 'results': results}) + '\n')
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--chroma_dir', type=str, default='./export/chroma', help='The path to the chroma directory')
+    args.add_argument('--collection_name', type=str, default='ais_basket', help='The name of the collection, its shards are included')
+    args.add_argument('--papers_info_dir', type=str, default='./export/papers_info', help='The path to the papers info directory')
+    args.add_argument('--query_source', type=str, default='chunk', choices=['chunk', 'hypothesis'], help='Sample the queries from the stored chunks or the extracted hypotheses')
+    args.add_argument('--num_queries', type=int, default=500, help='Number of queries')
+    args.add_argument('--k', type=int, default=10, help='Number of neighbors to evaluate')
+    args.add_argument('--max_vectors', type=int, default=0, help='Evaluate on a random subset of the vectors, 0 for all (skips the Chroma collection)')
+    args.add_argument('--hnsw_m', type=int, nargs='+', default=[16, 32], help='The M (graph degree) of the HNSW indexes')
+    args.add_argument('--ef_search', type=int, nargs='+', default=[16, 32, 64, 128, 256], help='The efSearch values of the HNSW indexes')
+    args.add_argument('--nlist', type=int, default=0, help='Number of IVF lists, 0 for 4 * sqrt(n)')
+    args.add_argument('--nprobe', type=int, nargs='+', default=[1, 4, 16, 64], help='The nprobe values of the IVF index')
+    args.add_argument('--threads', type=int, default=1, help='Number of faiss threads, 1 to measure single-query latency')
+    args.add_argument('--seed', type=int, default=42, help='Random seed of the query sample')
+    args.add_argument('--output', type=str, default=None, help='Append the results to this json lines file')
+    args = args.parse_args()
+
+    if not os.path.exists(args.chroma_dir):
+        print(f'[ERROR] Chroma directory {args.chroma_dir} does not exist')
+        exit(1)
+
+    main(args)
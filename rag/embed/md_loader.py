@@ -9,7 +9,8 @@ import sqlite3
 from langchain_text_splitters import MarkdownHeaderTextSplitter, RecursiveCharacterTextSplitter
 from langchain_core.documents import Document
 from typing import List
-import uuid
+import re
+import hashlib
 import pickle
 from tqdm import tqdm
 
@@ -31,6 +32,63 @@ def get_paper_title_journal_year(paper_id, args) -> tuple[str, str, int]:
     return title, journal, year
 
 
+def get_journal_id(journal):
+    """Get the canonical id of a journal, e.g. "The Journal of Strategic Information Systems" -> "journal_of_strategic_information_systems" """
+    journal = str(journal or '').lower().replace('&', ' and ')
+    journal = re.sub(r'^\s*the\s+', '', journal)
+    return re.sub(r'[^a-z0-9]+', '_', journal).strip('_')
+
+
+def get_section_id(section):
+    """Get the canonical id of a section, e.g. "Introduction" -> "introduction" """
+    return re.sub(r'[^a-z0-9]+', '_', str(section or '').lower()).strip('_')
+
+
+def get_paper_metadata(paper_id, paper_title, paper_journal, paper_year, section):
+    """
+    Get the typed metadata of a chunk. The year is an integer (-1 if unknown) and the journal and section
+    have canonical ids, so that range and IN filters can be pushed down to the vector store.
+    """
+    section = prettier_section(section) if section else ''
+    try:
+        paper_year = int(paper_year)
+    except (TypeError, ValueError):
+        paper_year = -1
+    return {
+        'paper_id': str(paper_id),
+        'paper_title': str(paper_title or ''),
+        'paper_journal': str(paper_journal or ''),
+        'paper_year': paper_year,
+        'journal_id': get_journal_id(paper_journal),
+        'section': section,
+        'section_id': get_section_id(section),
+    }
+
+
+def get_chunk_keys(contents):
+    """
+    Get the key of each chunk of a paper from its content.
+    Identical chunks in the same paper get an occurrence suffix, so every key is unique.
+    """
+    keys, seen = [], {}
+    for content in contents:
+        key = hashlib.sha1(content.encode('utf-8')).hexdigest()
+        seen[key] = seen.get(key, 0) + 1
+        keys.append(f'{key}:{seen[key]}')
+    return keys
+
+
+def get_chunk_id(paper_id, chunk_key):
+    return f"{paper_id}-{hashlib.sha1(chunk_key.encode('utf-8')).hexdigest()[:20]}"
+
+
+def set_chunk_ids(paper_id, docs):
+    """Give the chunks deterministic ids, so embedding a paper again overwrites its vectors instead of duplicating them"""
+    for doc, chunk_key in zip(docs, get_chunk_keys([doc.page_content for doc in docs])):
+        doc.id = get_chunk_id(paper_id, chunk_key)
+    return docs
+
+
 def get_paper_md(paper_id, args):
     """Get the markdown content of a paper"""
     paper_md_path = os.path.join(args.papers_mineru_dir, str(paper_id), 'txt', f'{paper_id}.md')
@@ -57,18 +115,11 @@ def get_paper_docs(paper_id, args):
     docs = []
     for md_header_split in md_header_splits:
         docs.append(Document(
-            id = str(uuid.uuid4()),
             page_content = md_header_split.page_content,
-            metadata = {
-                'paper_id': str(paper_id),
-                'paper_title': paper_title.title(),
-                'paper_journal': paper_journal.title(),
-                'paper_year': str(paper_year),
-                'section': prettier_section(md_header_split.metadata['section']) if 'section' in md_header_split.metadata else '',
-            },
+            metadata = get_paper_metadata(paper_id, paper_title, paper_journal, paper_year, md_header_split.metadata.get('section')),
         ))
 
-    return docs
+    return set_chunk_ids(paper_id, docs)
 
 
 def get_paper_docs_recursive(paper_id, args):
@@ -97,18 +148,11 @@ def get_paper_docs_recursive(paper_id, args):
         sub_docs = recursive_splitter.split_text(md_header_split.page_content)
         for sub_doc in sub_docs:
             docs.append(Document(
-                id = str(uuid.uuid4()),
                 page_content = sub_doc,
-                metadata = {
-                    'paper_id': str(paper_id),
-                    'paper_title': paper_title.title(),
-                    'paper_journal': paper_journal.title(),
-                    'paper_year': str(paper_year),
-                    'section': prettier_section(md_header_split.metadata['section']) if 'section' in md_header_split.metadata else '',
-                },
+                metadata = get_paper_metadata(paper_id, paper_title, paper_journal, paper_year, md_header_split.metadata.get('section')),
             ))
     
-    return docs
+    return set_chunk_ids(paper_id, docs)
 
 
 def prettier_section(section):
@@ -0,0 +1,224 @@
+from dotenv import load_dotenv, find_dotenv
+_ = load_dotenv(find_dotenv())
+
+import asyncio
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+from tqdm.asyncio import tqdm
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag.embed.md_loader import get_paper_md, get_paper_docs, get_paper_docs_recursive, get_paper_metadata, get_paper_title_journal_year, get_chunk_keys, get_chunk_id
+from rag.embed.create_embed import get_embeddings, get_vectorstore
+from rag.embed.shards import SHARD_BY, ShardedVectorStore
+from rag.embed.dedup_docs import ChunkDeduplicator
+from rag.lib.metrics import metrics
+
+
+def create_manifest_tables(conn):
+    """The manifest records the markdown and metadata hashes of each embedded paper and the keys of its chunks"""
+    conn.executescript('''
+        CREATE TABLE IF NOT EXISTS embed_paper (
+            collection TEXT,
+            paper_id TEXT,
+            md_hash TEXT,
+            chunker TEXT,
+            meta_hash TEXT,
+            PRIMARY KEY (collection, paper_id)
+        );
+        CREATE TABLE IF NOT EXISTS embed_chunk (
+            collection TEXT,
+            paper_id TEXT,
+            chunk_key TEXT,
+            doc_id TEXT,
+            PRIMARY KEY (collection, doc_id)
+        );
+        CREATE INDEX IF NOT EXISTS idx_embed_chunk_paper ON embed_chunk (collection, paper_id);
+    ''')
+    conn.commit()
+
+
+def hash_text(text):
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def get_meta_hash(paper_id, args):
+    """Hash the paper-level metadata of the chunks, so that a title fix or a new metadata field is detected"""
+    metadata = get_paper_metadata(paper_id, *get_paper_title_journal_year(paper_id, args), '')
+    return hash_text(json.dumps(metadata, sort_keys=True))
+
+
+def get_stored_chunks(conn, vectorstore, paper_id, stored_paper, args):
+    """
+    Get {chunk_key: doc_id} and {doc_id: metadata} of the stored chunks of a paper. The keys come from the
+    manifest or, for papers embedded before it, from Chroma.
+    """
+    stored = vectorstore.get(where={'paper_id': paper_id}, include=['documents', 'metadatas'] if stored_paper is None else ['metadatas'])
+    stored_metadatas = dict(zip(stored['ids'], stored['metadatas']))
+    if stored_paper is None:
+        return dict(zip(get_chunk_keys(stored['documents']), stored['ids'])), stored_metadatas
+
+    rows = conn.execute('''
+        SELECT chunk_key, doc_id FROM embed_chunk WHERE collection = ? AND paper_id = ?
+    ''', (args.collection_name, paper_id)).fetchall()
+    return dict(rows), stored_metadatas
+
+
+def update_metadatas(vectorstore, ids, metadatas):
+    """Update the metadata of stored chunks in place, without embedding them again"""
+    if isinstance(vectorstore, ShardedVectorStore):
+        vectorstore.update_metadatas(ids, metadatas)
+    else:
+        vectorstore._collection.update(ids=ids, metadatas=metadatas)
+
+
+def save_manifest(conn, paper_id, md_hash, meta_hash, chunks, args):
+    conn.execute('DELETE FROM embed_chunk WHERE collection = ? AND paper_id = ?', (args.collection_name, paper_id))
+    conn.executemany('''
+        INSERT INTO embed_chunk (collection, paper_id, chunk_key, doc_id) VALUES (?, ?, ?, ?)
+    ''', [(args.collection_name, paper_id, chunk_key, doc_id) for chunk_key, doc_id in chunks.items()])
+    conn.execute('''
+        INSERT OR REPLACE INTO embed_paper (collection, paper_id, md_hash, chunker, meta_hash) VALUES (?, ?, ?, ?, ?)
+    ''', (args.collection_name, paper_id, md_hash, get_chunker(args), meta_hash))
+    conn.commit()
+
+
+def get_chunker(args):
+    return f"{'recursive' if args.recursive else 'section'}{'+dedup' if args.dedup else ''}"
+
+
+async def reindex_one_paper(paper_id, conn, vectorstore, semaphore, args, deduplicator=None):
+    """
+    Re-embed only the new chunks of a paper whose markdown changed since it was last indexed.
+    The chunks are keyed on their content, so a chunk whose metadata changed is updated in place.
+    """
+    async with semaphore:
+        try:
+            paper_md = get_paper_md(paper_id, args)
+            md_hash = hash_text(paper_md) if paper_md else ''
+            meta_hash = get_meta_hash(paper_id, args)
+            stored_paper = conn.execute('''
+                SELECT md_hash, chunker, meta_hash FROM embed_paper WHERE collection = ? AND paper_id = ?
+            ''', (args.collection_name, paper_id)).fetchone()
+            if stored_paper == (md_hash, get_chunker(args), meta_hash):
+                return {"paper_id": paper_id, "status": "unchanged", "added": 0, "removed": 0, "updated": 0}
+
+            with metrics.timer('chunk'):
+                if args.recursive:
+                    paper_docs = get_paper_docs_recursive(paper_id, args)
+                else:
+                    paper_docs = get_paper_docs(paper_id, args)
+            if deduplicator is not None:
+                with metrics.timer('dedup'):
+                    paper_docs = deduplicator.filter(paper_docs)
+
+            chunk_keys = get_chunk_keys([doc.page_content for doc in paper_docs])
+            stored_chunks, stored_metadatas = get_stored_chunks(conn, vectorstore, paper_id, stored_paper, args)
+
+            # Deterministic ids, so the ids in the manifest always match the vectors
+            new_docs, updated_docs = [], []
+            chunks = {}
+            for chunk_key, doc in zip(chunk_keys, paper_docs):
+                if chunk_key in stored_chunks:
+                    doc.id = stored_chunks[chunk_key]
+                    if stored_metadatas.get(doc.id) != doc.metadata:
+                        updated_docs.append(doc)
+                else:
+                    doc.id = get_chunk_id(paper_id, chunk_key)
+                    new_docs.append(doc)
+                chunks[chunk_key] = doc.id
+            removed_ids = [doc_id for chunk_key, doc_id in stored_chunks.items() if chunk_key not in chunks]
+
+            for i in range(0, len(new_docs), 64):
+                await asyncio.to_thread(vectorstore.add_documents, new_docs[i:i + 64], ids=[doc.id for doc in new_docs[i:i + 64]])
+            if updated_docs:
+                with metrics.timer('chroma_update'):
+                    await asyncio.to_thread(update_metadatas, vectorstore, [doc.id for doc in updated_docs], [doc.metadata for doc in updated_docs])
+            if removed_ids:
+                with metrics.timer('chroma_delete'):
+                    await asyncio.to_thread(vectorstore.delete, ids=removed_ids)
+
+            save_manifest(conn, paper_id, md_hash, meta_hash, chunks, args)
+            metrics.inc('chunks_total', len(new_docs), stage='reindex', action='added')
+            metrics.inc('chunks_total', len(updated_docs), stage='reindex', action='updated')
+            metrics.inc('chunks_total', len(removed_ids), stage='reindex', action='removed')
+            return {"paper_id": paper_id, "status": "new" if stored_paper is None and not stored_chunks else "updated", "added": len(new_docs), "removed": len(removed_ids), "updated": len(updated_docs)}
+
+        except Exception as e:
+            print(f"[ERROR] Error reindexing paper {paper_id}: {e}")
+            return {"paper_id": paper_id, "status": "error", "added": 0, "removed": 0, "updated": 0}
+
+
+async def main(args):
+    """Re-index the papers whose markdown changed, in time proportional to the change"""
+    if args.metrics_dir:
+        metrics.start(args.metrics_dir, args.metrics_interval)
+    vectorstore = get_vectorstore(args, get_embeddings())
+    conn = sqlite3.connect(args.db_path)
+    create_manifest_tables(conn)
+    deduplicator = ChunkDeduplicator.load(args.dedup_index) if args.dedup else None
+
+    paper_ids = sorted(i for i in os.listdir(args.papers_mineru_dir) if os.path.isdir(os.path.join(args.papers_mineru_dir, i)))
+    print(f"[INFO] Found {len(paper_ids)} paper folders")
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    tasks = [reindex_one_paper(paper_id, conn, vectorstore, semaphore, args, deduplicator) for paper_id in paper_ids]
+    results = []
+    for task in tqdm(asyncio.as_completed(tasks), total=len(tasks), desc="Reindexing"):
+        result = await task
+        metrics.inc('papers_total', stage='reindex', status=result['status'])
+        results.append(result)
+
+    # Papers whose folder was removed
+    if args.prune:
+        indexed_paper_ids = [i[0] for i in conn.execute('SELECT paper_id FROM embed_paper WHERE collection = ?', (args.collection_name,))]
+        for paper_id in set(indexed_paper_ids) - set(paper_ids):
+            doc_ids = [i[0] for i in conn.execute('SELECT doc_id FROM embed_chunk WHERE collection = ? AND paper_id = ?', (args.collection_name, paper_id))]
+            if doc_ids:
+                vectorstore.delete(ids=doc_ids)
+            conn.execute('DELETE FROM embed_chunk WHERE collection = ? AND paper_id = ?', (args.collection_name, paper_id))
+            conn.execute('DELETE FROM embed_paper WHERE collection = ? AND paper_id = ?', (args.collection_name, paper_id))
+            conn.commit()
+            results.append({"paper_id": paper_id, "status": "pruned", "added": 0, "removed": len(doc_ids), "updated": 0})
+    conn.close()
+
+    if deduplicator is not None and args.dedup_index:
+        deduplicator.save(args.dedup_index)
+
+    for status in ['unchanged', 'new', 'updated', 'pruned', 'error']:
+        print(f"[INFO] {status.capitalize()}: {sum(1 for r in results if r['status'] == status)}")
+    print(f"[INFO] Added chunks: {sum(r['added'] for r in results)}")
+    print(f"[INFO] Removed chunks: {sum(r['removed'] for r in results)}")
+    print(f"[INFO] Chunks with updated metadata: {sum(r['updated'] for r in results)}")
+
+    if args.metrics_dir:
+        metrics.stop()
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--papers_mineru_dir', type=str, default='./export/papers_mineru', help='The path to the papers mineru directory')
+    args.add_argument('--chroma_dir', type=str, default='./export/chroma', help='The path to the chroma directory')
+    args.add_argument('--collection_name', type=str, default='ais_basket', help='The name of the collection')
+    args.add_argument('--db_path', type=str, default='./export/db/academy.db', help='The path to the database file, which also keeps the manifest')
+    args.add_argument('--recursive', action='store_true', help='Use recursive mode')
+    args.add_argument('--shard_by', type=str, default='none', choices=SHARD_BY, help='Split the collection into shards by year bucket or journal')
+    args.add_argument('--year_bucket', type=int, default=5, help='Number of years in a year shard')
+    args.add_argument('--dedup', action='store_true', help='Filter boilerplate, reference lists and near-duplicate chunks before embedding')
+    args.add_argument('--dedup_index', type=str, default='./export/chroma/dedup_index.pkl', help='The path to persist the dedup index across runs')
+    args.add_argument('--prune', action='store_true', help='Delete the vectors of papers whose folder no longer exists')
+    args.add_argument('--concurrency', type=int, default=10, help='Number of papers to reindex concurrently')
+    args.add_argument('--metrics_dir', type=str, default='./export/metrics/reindex_embed', help='The path to write the metrics (json lines and prometheus text), empty to disable')
+    args.add_argument('--metrics_interval', type=float, default=15.0, help='Interval (in seconds) between metrics writes')
+    args = args.parse_args()
+
+    if not os.path.exists(args.papers_mineru_dir):
+        print(f'[ERROR] Papers mineru directory {args.papers_mineru_dir} does not exist')
+        exit(1)
+
+    os.makedirs(args.chroma_dir, exist_ok=True)
+
+    asyncio.run(main(args))
@@ -0,0 +1,175 @@
+import heapq
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import chromadb
+from langchain_chroma import Chroma
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag.embed.md_loader import get_journal_id
+
+
+SHARD_BY = ['none', 'year', 'journal']
+
+
+def slugify(text):
+    """A collection-safe name: lowercase alphanumerics separated by single underscores"""
+    return re.sub(r'[^a-z0-9]+', '_', str(text).lower()).strip('_') or 'unknown'
+
+
+def get_year_shard(year, year_bucket):
+    try:
+        year = int(year)
+    except (TypeError, ValueError):
+        return 'y_unknown'
+    if year <= 0:
+        return 'y_unknown'
+    start = year - year % year_bucket
+    return f'y{start}_{start + year_bucket - 1}'
+
+
+def get_shard_name(metadata, shard_by, year_bucket=5):
+    """Get the shard of a chunk from its metadata"""
+    if shard_by == 'year':
+        return get_year_shard(metadata.get('paper_year'), year_bucket)
+    if shard_by == 'journal':
+        return f"j_{slugify(metadata.get('journal_id') or get_journal_id(metadata.get('paper_journal')))}"
+    return 'all'
+
+
+class ShardedVectorStore:
+    """
+    A set of Chroma collections named {collection_name}__{shard}, one per year bucket or journal.
+    Writes are routed to the shard of each chunk, and searches fan out in parallel across only the
+    relevant shards and merge the top-k. It has the parts of the Chroma interface used by the embedding
+    scripts, so it can be used in place of a single collection.
+    """
+    def __init__(self, embedding_function, persist_directory, collection_name, shard_by='year', year_bucket=5, max_workers=None):
+        assert shard_by in SHARD_BY, f'shard_by should be one of {SHARD_BY}'
+        self.embeddings = embedding_function
+        self.client = chromadb.PersistentClient(path=persist_directory)
+        self.collection_name = collection_name
+        self.shard_by = shard_by
+        self.year_bucket = year_bucket
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or os.cpu_count())
+        self.shards = {}
+        self.lock = threading.Lock()
+
+    def get_shard(self, shard_name):
+        with self.lock:
+            if shard_name not in self.shards:
+                self.shards[shard_name] = Chroma(
+                    client=self.client,
+                    embedding_function=self.embeddings,
+                    collection_name=f'{self.collection_name}__{shard_name}',
+                )
+            return self.shards[shard_name]
+
+    def list_shards(self):
+        """Get the names of the existing shards of the collection"""
+        prefix = f'{self.collection_name}__'
+        # Depending on the chromadb version, collections or their names are returned
+        names = [getattr(i, 'name', i) for i in self.client.list_collections()]
+        return sorted(i[len(prefix):] for i in names if i.startswith(prefix))
+
+    def select_shards(self, year_range=None, journals=None):
+        """Get the shards that can contain the chunks of the year range (inclusive, either end can be None) and journals"""
+        shards = self.list_shards()
+        if self.shard_by == 'year' and year_range:
+            min_year = year_range[0] if year_range[0] is not None else float('-inf')
+            max_year = year_range[1] if year_range[1] is not None else float('inf')
+            selected = []
+            for shard in shards:
+                match = re.match(r'y(\d+)_(\d+)$', shard)
+                if match is None or (int(match.group(2)) >= min_year and int(match.group(1)) <= max_year):
+                    selected.append(shard)
+            return selected
+        if self.shard_by == 'journal' and journals:
+            journal_shards = {f'j_{slugify(get_journal_id(i))}' for i in journals}
+            return [i for i in shards if i in journal_shards]
+        return shards
+
+    def map_shards(self, fn, shard_names):
+        """Run fn(shard) on the shards in parallel"""
+        return list(self.executor.map(lambda shard_name: fn(self.get_shard(shard_name)), shard_names))
+
+    def add_documents(self, documents, **kwargs):
+        groups = {}
+        for i, doc in enumerate(documents):
+            groups.setdefault(get_shard_name(doc.metadata, self.shard_by, self.year_bucket), []).append(i)
+
+        ids = kwargs.pop('ids', None)
+
+        def add(shard_name, indexes):
+            if ids:
+                return self.get_shard(shard_name).add_documents([documents[i] for i in indexes], ids=[ids[i] for i in indexes], **kwargs)
+            return self.get_shard(shard_name).add_documents([documents[i] for i in indexes], **kwargs)
+
+        # The chunks of a paper usually go to one shard, so the caller's thread does the work
+        if len(groups) == 1:
+            return add(*next(iter(groups.items())))
+        results = list(self.executor.map(lambda item: add(*item), groups.items()))
+        return [doc_id for result in results for doc_id in result]
+
+    def get(self, where=None, limit=None, include=None, shards=None):
+        """Get the chunks matching the filter from all the shards, in the format of Chroma.get"""
+        include = ['documents', 'metadatas'] if include is None else include
+        results = self.map_shards(lambda shard: shard.get(where=where, limit=limit, include=include), shards or self.list_shards())
+        # The same shape with any number of shards, the fields which are not included are None
+        merged = {'ids': [], 'included': include}
+        merged.update({key: [] if key in include else None for key in ['embeddings', 'documents', 'metadatas']})
+        for result in results:
+            for key in ['ids', 'embeddings', 'documents', 'metadatas']:
+                if merged[key] is not None and result.get(key) is not None:
+                    merged[key].extend(list(result[key]))
+        if limit is not None:
+            merged.update({key: merged[key][:limit] for key in ['ids', 'embeddings', 'documents', 'metadatas'] if merged[key] is not None})
+        return merged
+
+    def delete(self, ids=None, shards=None):
+        self.map_shards(lambda shard: shard.delete(ids=ids), shards or self.list_shards())
+
+    def update_metadatas(self, ids, metadatas):
+        """
+        Update the metadata of chunks in place. A chunk whose new metadata belongs to another shard is moved
+        there with its stored embedding, so it is not embedded again.
+        """
+        targets = {doc_id: (get_shard_name(metadata, self.shard_by, self.year_bucket), metadata) for doc_id, metadata in zip(ids, metadatas)}
+
+        def update(shard_name):
+            collection = self.get_shard(shard_name)._collection
+            stored_ids = collection.get(ids=ids, include=[])['ids']
+            kept = [i for i in stored_ids if targets[i][0] == shard_name]
+            if kept:
+                collection.update(ids=kept, metadatas=[targets[i][1] for i in kept])
+            moved = [i for i in stored_ids if targets[i][0] != shard_name]
+            if moved:
+                stored = collection.get(ids=moved, include=['embeddings', 'documents'])
+                for doc_id, embedding, document in zip(stored['ids'], stored['embeddings'], stored['documents']):
+                    target_shard, metadata = targets[doc_id]
+                    self.get_shard(target_shard)._collection.upsert(ids=[doc_id], embeddings=[embedding], documents=[document], metadatas=[metadata])
+                collection.delete(ids=moved)
+
+        list(self.executor.map(update, self.list_shards()))
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k=4, filter=None, shards=None):
+        """Search the shards in parallel with an embedded query, and merge their top-k by distance"""
+        results = self.map_shards(
+            lambda shard: shard.similarity_search_by_vector_with_relevance_scores(embedding, k=k, filter=filter),
+            self.list_shards() if shards is None else shards,
+        )
+        return heapq.nsmallest(k, (i for result in results for i in result), key=lambda i: i[1])
+
+    def similarity_search_with_score(self, query, k=4, filter=None, year_range=None, journals=None):
+        shards = self.select_shards(year_range, journals)
+        if not shards:
+            return []
+        # Embed the query once for all the shards
+        embedding = self.embeddings.embed_query(query)
+        return self.similarity_search_by_vector_with_relevance_scores(embedding, k=k, filter=filter, shards=shards)
+
+    def similarity_search(self, query, k=4, filter=None, year_range=None, journals=None):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter, year_range, journals)]
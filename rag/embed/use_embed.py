@@ -5,25 +5,206 @@ _ = load_dotenv(find_dotenv())
 import argparse
 import os
 import pickle
+import sqlite3
+import numpy as np
 from langchain_chroma import Chroma
+from langchain_core.documents import Document
 from langchain_openai import OpenAIEmbeddings
 
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from rag.embed.md_loader import get_journal_id, get_section_id
+from rag.embed.shards import SHARD_BY, ShardedVectorStore
 
-def get_docs_by_query(query, vectorstore, k=10):
-    docs = vectorstore.similarity_search(query, k=k)
+
+# Above this many prefiltered papers, the ids are not passed to Chroma, whose queries have a bound-variable limit
+MAX_PREFILTER_IDS = 5000
+
+
+def get_docs_by_query(query, vectorstore, k=10, filter=None):
+    docs = vectorstore.similarity_search(query, k=k, filter=filter)
     return docs
 
 
+def build_filter(paper_ids=None, year_range=None, journals=None, sections=None):
+    """
+    Build a Chroma where filter over the typed chunk metadata.
+    year_range is an inclusive (min_year, max_year) tuple, either end can be None; journals and sections
+    are matched by their canonical ids, and all the conditions are combined with AND.
+    """
+    conditions = []
+    if year_range:
+        if year_range[0] is not None:
+            conditions.append({'paper_year': {'$gte': int(year_range[0])}})
+        if year_range[1] is not None:
+            conditions.append({'paper_year': {'$lte': int(year_range[1])}})
+    if journals:
+        conditions.append({'journal_id': {'$in': [get_journal_id(i) for i in journals]}})
+    if sections:
+        conditions.append({'section_id': {'$in': [get_section_id(i) for i in sections]}})
+    if paper_ids is not None:
+        conditions.append({'paper_id': {'$in': [str(i) for i in paper_ids]}})
+
+    if not conditions:
+        return None
+    return conditions[0] if len(conditions) == 1 else {'$and': conditions}
+
+
+def prefilter_paper_ids(db_path, year_range=None, journals=None):
+    """Get the ids of the papers in the year range (inclusive) and journals from the paper table"""
+    conn = sqlite3.connect(db_path)
+    conn.create_function('journal_id', 1, get_journal_id, deterministic=True)
+    conditions, params = [], []
+    if year_range:
+        conditions.append('year BETWEEN ? AND ?')
+        params.extend([year_range[0] if year_range[0] is not None else -1, year_range[1] if year_range[1] is not None else 9999])
+    if journals:
+        conditions.append(f"journal_id(journal) IN ({', '.join('?' * len(journals))})")
+        params.extend(get_journal_id(i) for i in journals)
+    try:
+        rows = conn.execute(f'''
+            SELECT id FROM paper {'WHERE ' + ' AND '.join(conditions) if conditions else ''}
+        ''', params).fetchall()
+    finally:
+        conn.close()
+    return [str(i[0]) for i in rows]
+
+
+def query_candidates(embedding, vectorstore, fetch_k, filter=None, year_range=None, journals=None):
+    """Get the fetch_k nearest chunks with their embeddings, as (docs, embeddings, distances) sorted by distance"""
+    if isinstance(vectorstore, ShardedVectorStore):
+        shards = [vectorstore.get_shard(i) for i in vectorstore.select_shards(year_range, journals)]
+    else:
+        shards = [vectorstore]
+    if not shards:
+        return [], np.zeros((0, len(embedding))), np.zeros(0)
+
+    def query_shard(shard):
+        return shard._collection.query(
+            query_embeddings=[embedding], n_results=fetch_k, where=filter,
+            include=['embeddings', 'documents', 'metadatas', 'distances'],
+        )
+
+    if isinstance(vectorstore, ShardedVectorStore):
+        results = list(vectorstore.executor.map(query_shard, shards))
+    else:
+        results = [query_shard(shards[0])]
+
+    docs, embeddings, distances = [], [], []
+    for result in results:
+        for doc_id, content, metadata, doc_embedding, distance in zip(
+            result['ids'][0], result['documents'][0], result['metadatas'][0], result['embeddings'][0], result['distances'][0]
+        ):
+            docs.append(Document(id=doc_id, page_content=content, metadata=metadata or {}))
+            embeddings.append(doc_embedding)
+            distances.append(distance)
+    if not docs:
+        return [], np.zeros((0, len(embedding))), np.zeros(0)
+
+    order = np.argsort(distances, kind='stable')[:fetch_k]
+    return [docs[i] for i in order], np.asarray(embeddings, dtype=np.float32)[order], np.asarray(distances)[order]
+
+
+def mmr_select(query_embedding, embeddings, k, lambda_mult=0.5, paper_ids=None, max_per_paper=None):
+    """
+    Select k candidates by maximal marginal relevance, return their indexes in the order selected.
+    The candidate similarities are computed in one matrix product, then each greedy step only updates the
+    running max similarity to the selected candidates. With paper_ids, at most max_per_paper candidates of
+    each paper are selected.
+    """
+    if len(embeddings) == 0 or k <= 0:
+        return []
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    query_embedding = np.asarray(query_embedding, dtype=np.float32)
+    query_embedding = query_embedding / max(np.linalg.norm(query_embedding), 1e-12)
+
+    relevance = embeddings @ query_embedding
+    similarity = embeddings @ embeddings.T
+    max_similarity = np.zeros(len(embeddings), dtype=np.float32)
+    available = np.ones(len(embeddings), dtype=bool)
+    if paper_ids is not None and max_per_paper:
+        _, paper_codes = np.unique(np.asarray(paper_ids, dtype=str), return_inverse=True)
+        paper_counts = np.zeros(paper_codes.max() + 1, dtype=int)
+
+    selected = []
+    while len(selected) < k and available.any():
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        i = int(np.argmax(scores))
+        selected.append(i)
+        available[i] = False
+        max_similarity = np.maximum(max_similarity, similarity[i])
+        if paper_ids is not None and max_per_paper:
+            paper_counts[paper_codes[i]] += 1
+            if paper_counts[paper_codes[i]] >= max_per_paper:
+                available[paper_codes == paper_codes[i]] = False
+    return selected
+
+
+def diverse_search(query, vectorstore, k=10, fetch_k=None, lambda_mult=0.5, max_per_paper=1, filter=None, year_range=None, journals=None):
+    """
+    Search the fetch_k nearest chunks (5 * k by default) and return k of them as (doc, distance), diversified
+    by maximal marginal relevance with at most max_per_paper chunks of each paper.
+    lambda_mult is 1 for pure relevance and 0 for maximal diversity, max_per_paper None to not collapse papers.
+    """
+    embedding = vectorstore.embeddings.embed_query(query)
+    docs, embeddings, distances = query_candidates(embedding, vectorstore, fetch_k or 5 * k, filter, year_range, journals)
+    paper_ids = [doc.metadata.get('paper_id') for doc in docs]
+    selected = mmr_select(embedding, embeddings, k, lambda_mult, paper_ids, max_per_paper)
+    return [(docs[i], float(distances[i])) for i in selected]
+
+
+def search_with_filters(query, vectorstore, k=10, year_range=None, journals=None, sections=None, db_path=None, diverse=False, **diverse_kwargs):
+    """
+    Search with the filters pushed down to the vector store, so only the matching chunks are scored.
+    With db_path, the papers are prefiltered in SQLite and the search is restricted to the candidate paper
+    ids, which also works for chunks embedded before the metadata was typed, unless there are more than
+    MAX_PREFILTER_IDS candidates. year_range is inclusive and either end can be None.
+    With diverse, the results are diversified by diverse_search, which takes the diverse_kwargs.
+    """
+    if year_range and year_range[0] is None and year_range[1] is None:
+        year_range = None
+    paper_ids = None
+    if db_path and (year_range or journals):
+        paper_ids = prefilter_paper_ids(db_path, year_range, journals)
+        if not paper_ids:
+            return []
+    if paper_ids is not None and len(paper_ids) <= MAX_PREFILTER_IDS:
+        filter = build_filter(paper_ids=paper_ids, sections=sections)
+    else:
+        # Too many candidate papers for an $in list, the filters are pushed down on the chunk metadata instead
+        filter = build_filter(year_range=year_range, journals=journals, sections=sections)
+
+    if diverse:
+        return diverse_search(query, vectorstore, k=k, filter=filter, year_range=year_range, journals=journals, **diverse_kwargs)
+    if isinstance(vectorstore, ShardedVectorStore):
+        return vectorstore.similarity_search_with_score(query=query, k=k, filter=filter, year_range=year_range, journals=journals)
+    return vectorstore.similarity_search_with_score(query=query, k=k, filter=filter)
+
+
 def main(args):
     embeddings = OpenAIEmbeddings(model=os.environ['EMBEDDING_MODEL'], dimensions=1024)
-    vectorstore = Chroma(
-        embedding_function=embeddings,
-        persist_directory=args.chroma_dir,
-        collection_name='ais_basket',
-    )
-    
     query = 'The community building goal is achieved through the creative combinations of membership'
-    results = vectorstore.similarity_search_with_score(query=query, k=3)
+    if args.shard_by != 'none':
+        # Only the shards of the year range or journals are searched, in parallel
+        vectorstore = ShardedVectorStore(
+            embedding_function=embeddings,
+            persist_directory=args.chroma_dir,
+            collection_name='ais_basket',
+            shard_by=args.shard_by,
+            year_bucket=args.year_bucket,
+        )
+    else:
+        vectorstore = Chroma(
+            embedding_function=embeddings,
+            persist_directory=args.chroma_dir,
+            collection_name='ais_basket',
+        )
+    results = search_with_filters(
+        query, vectorstore, k=3, year_range=args.years, journals=args.journals, sections=args.sections,
+        db_path=args.db_path if args.prefilter else None,
+        diverse=args.diverse, fetch_k=args.fetch_k, lambda_mult=args.lambda_mult, max_per_paper=args.max_per_paper or None,
+    )
     for res, score in results:
         print(f"* {res.page_content}")
         print(f"[{res.metadata}]")
@@ -53,6 +234,17 @@ def dev(args):
 if __name__ == '__main__':
     args = argparse.ArgumentParser()
     args.add_argument('--chroma_dir', type=str, default='./export/chroma', help='The path to the chroma directory')
+    args.add_argument('--shard_by', type=str, default='none', choices=SHARD_BY, help='Search the shards created with the same --shard_by')
+    args.add_argument('--year_bucket', type=int, default=5, help='Number of years in a year shard')
+    args.add_argument('--db_path', type=str, default='./export/db/academy.db', help='The path to the database file')
+    args.add_argument('--years', type=int, nargs=2, default=None, help='Only search the chunks of this year range (inclusive)')
+    args.add_argument('--journals', type=str, nargs='+', default=None, help='Only search the chunks of these journals')
+    args.add_argument('--sections', type=str, nargs='+', default=None, help='Only search the chunks of these sections')
+    args.add_argument('--prefilter', action='store_true', help='Prefilter the papers by year and journal in the database')
+    args.add_argument('--diverse', action='store_true', help='Diversify the results by maximal marginal relevance and collapse them per paper')
+    args.add_argument('--fetch_k', type=int, default=None, help='Number of candidates of the diverse search, defaults to 5 * k')
+    args.add_argument('--lambda_mult', type=float, default=0.5, help='Relevance weight of the diverse search, 1 for pure relevance and 0 for maximal diversity')
+    args.add_argument('--max_per_paper', type=int, default=1, help='Maximum number of chunks of a paper in the diverse search, 0 for no limit')
     args.add_argument('--dev', action='store_true', help='Use dev mode')
     args = args.parse_args()
     
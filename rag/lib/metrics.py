@@ -0,0 +1,230 @@
+import os
+import json
+import re
+import asyncio
+import threading
+import time
+from contextlib import contextmanager
+
+
+# USD per 1M tokens: (prompt, completion). Override or extend with the MODEL_PRICES env, e.g. '{"my-model": [0.1, 0.4]}'
+MODEL_PRICES = {
+    'gpt-4o-mini': (0.15, 0.6),
+    'gpt-4o': (2.5, 10.0),
+    'gpt-4.1-mini': (0.4, 1.6),
+    'gemini-2.5-flash': (0.3, 2.5),
+    'gemini-2.5-flash-all': (0.3, 2.5),
+    'text-embedding-3-small': (0.02, 0.0),
+    'text-embedding-3-large': (0.13, 0.0),
+}
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+# Responses that the openai client retries
+RETRY_STATUSES = (408, 409, 429, 500, 502, 503, 504)
+
+
+def get_route(path):
+    """Get the route template of an API path to use as a label, e.g. /v1/batches/batch_abc -> /v1/batches/{id}"""
+    return '/'.join(i if re.fullmatch(r'v\d+', i) or not re.search(r'\d', i) else '{id}' for i in path.split('/'))
+
+
+def get_model_price(model):
+    prices = dict(MODEL_PRICES)
+    if os.environ.get('MODEL_PRICES'):
+        prices.update({k: tuple(v) for k, v in json.loads(os.environ['MODEL_PRICES']).items()})
+    return prices.get(model, (0.0, 0.0))
+
+
+class Metrics:
+    """
+    Counters, gauges and latency histograms shared by all stages.
+    Every metric has a name and optional labels, and the snapshot is written as JSON lines and as a
+    Prometheus text file, periodically in a background thread during long runs.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+        self.metrics_dir = None
+        self.stop_event = None
+        self.thread = None
+        self.http_clients = {}
+
+    @staticmethod
+    def key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[self.key(name, labels)] = value
+
+    def add(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self.key(name, labels)
+        with self.lock:
+            if key not in self.histograms:
+                self.histograms[key] = {'buckets': [0] * len(LATENCY_BUCKETS), 'count': 0, 'sum': 0.0}
+            histogram = self.histograms[key]
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if value <= bound:
+                    histogram['buckets'][i] += 1
+            histogram['count'] += 1
+            histogram['sum'] += value
+
+    @contextmanager
+    def timer(self, stage, **labels):
+        """Time a block of a stage, works in both sync and async code"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe('stage_seconds', time.perf_counter() - start, stage=stage, **labels)
+
+    def add_tokens(self, model, prompt_tokens=0, completion_tokens=0, kind='chat', discount=1.0):
+        """Count the tokens of a model call and its estimated cost, discount is e.g. 0.5 for the batch API"""
+        prompt_price, completion_price = get_model_price(model)
+        self.inc('tokens_total', prompt_tokens, model=model, kind=kind, type='prompt')
+        if completion_tokens:
+            self.inc('tokens_total', completion_tokens, model=model, kind=kind, type='completion')
+        self.inc('cost_usd_total', (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1e6 * discount, model=model)
+
+    def record_chat_usage(self, model, message):
+        """Count the tokens of a LangChain chat response"""
+        usage = getattr(message, 'usage_metadata', None) or {}
+        self.add_tokens(model, usage.get('input_tokens', 0), usage.get('output_tokens', 0))
+
+    def record_embedding_usage(self, response):
+        """Count the tokens reported by a successful embeddings response, whose body has been read"""
+        try:
+            body = response.json()
+        except ValueError:
+            return
+        usage = body.get('usage') or {}
+        self.add_tokens(body.get('model', ''), usage.get('prompt_tokens', 0), kind='embedding')
+
+    def on_response(self, response):
+        """Count the status, retries and latency of an API response"""
+        path = get_route(response.request.url.path)
+        self.inc('api_responses_total', path=path, status=str(response.status_code))
+        if response.status_code == 429:
+            self.inc('api_rate_limited_total', path=path)
+        if response.status_code in RETRY_STATUSES:
+            self.inc('api_retries_total', path=path)
+        start = response.request.extensions.get('metrics_start')
+        if start is not None:
+            self.observe('api_request_seconds', time.perf_counter() - start, path=path)
+
+    def get_http_clients(self):
+        """
+        Get the sync and async httpx clients which report every API response to the metrics.
+        The clients are shared by the calls in the same event loop, as an async client can not be used across loops.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop in self.http_clients:
+            return self.http_clients[loop]
+        import httpx
+
+        def on_request(request):
+            request.extensions['metrics_start'] = time.perf_counter()
+
+        async def on_request_async(request):
+            on_request(request)
+
+        def on_response(response):
+            self.on_response(response)
+            if response.status_code == 200 and response.request.url.path.endswith('/embeddings'):
+                response.read()
+                self.record_embedding_usage(response)
+
+        async def on_response_async(response):
+            self.on_response(response)
+            if response.status_code == 200 and response.request.url.path.endswith('/embeddings'):
+                await response.aread()
+                self.record_embedding_usage(response)
+
+        http_client = httpx.Client(event_hooks={'request': [on_request], 'response': [on_response]})
+        http_async_client = httpx.AsyncClient(event_hooks={'request': [on_request_async], 'response': [on_response_async]})
+        self.http_clients[loop] = http_client, http_async_client
+        return self.http_clients[loop]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'timestamp': time.time(),
+                'counters': [{'name': k[0], 'labels': dict(k[1]), 'value': v} for k, v in self.counters.items()],
+                'gauges': [{'name': k[0], 'labels': dict(k[1]), 'value': v} for k, v in self.gauges.items()],
+                'histograms': [{'name': k[0], 'labels': dict(k[1]), **v} for k, v in self.histograms.items()],
+            }
+
+    def to_prometheus(self, prefix='academy_'):
+        """Format the metrics in the Prometheus text exposition format"""
+        def format_labels(labels, extra=None):
+            labels = {**labels, **(extra or {})}
+            if not labels:
+                return ''
+            return '{' + ','.join(f'{k}="{str(v)}"' for k, v in labels.items()) + '}'
+
+        snapshot = self.snapshot()
+        lines = []
+        for kind, metric_type in [('counters', 'counter'), ('gauges', 'gauge')]:
+            for name in sorted({i['name'] for i in snapshot[kind]}):
+                lines.append(f'# TYPE {prefix}{name} {metric_type}')
+                for i in snapshot[kind]:
+                    if i['name'] == name:
+                        lines.append(f"{prefix}{name}{format_labels(i['labels'])} {i['value']}")
+        for name in sorted({i['name'] for i in snapshot['histograms']}):
+            lines.append(f'# TYPE {prefix}{name} histogram')
+            for i in snapshot['histograms']:
+                if i['name'] != name:
+                    continue
+                for bound, count in zip(LATENCY_BUCKETS, i['buckets']):
+                    lines.append(f"{prefix}{name}_bucket{format_labels(i['labels'], {'le': bound})} {count}")
+                lines.append(f"{prefix}{name}_bucket{format_labels(i['labels'], {'le': '+Inf'})} {i['count']}")
+                lines.append(f"{prefix}{name}_sum{format_labels(i['labels'])} {i['sum']}")
+                lines.append(f"{prefix}{name}_count{format_labels(i['labels'])} {i['count']}")
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Append the snapshot to metrics.jsonl and replace metrics.prom"""
+        if not self.metrics_dir:
+            return
+        with open(os.path.join(self.metrics_dir, 'metrics.jsonl'), 'a', encoding='utf-8') as f:
+            f.write(json.dumps(self.snapshot()) + '\n')
+        prom_path = os.path.join(self.metrics_dir, 'metrics.prom')
+        with open(f'{prom_path}.tmp', 'w', encoding='utf-8') as f:
+            f.write(self.to_prometheus())
+        os.replace(f'{prom_path}.tmp', prom_path)
+
+    def start(self, metrics_dir, interval=15.0):
+        """Write the metrics every interval seconds until stop() is called"""
+        self.metrics_dir = metrics_dir
+        os.makedirs(metrics_dir, exist_ok=True)
+        self.stop_event = threading.Event()
+
+        def run():
+            while not self.stop_event.wait(interval):
+                self.write()
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
+            self.thread.join()
+        self.write()
+
+
+metrics = Metrics()
@@ -6,6 +6,9 @@ import os
 import subprocess
 import time
 
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+
 def run_mineru(file_path, output_dir):
     """
     使用subprocess确保命令执行完成后再返回。
@@ -20,7 +23,7 @@ def run_mineru(file_path, output_dir):
         print(f"mineru 执行失败，错误: {e}")
 
 
-def main(root_dir, input_dir, output_dir):
+def main(root_dir, input_dir, output_dir, db_path=None):
     # 获取所有 PDF 文件
     input_path = os.path.join(root_dir, input_dir)
     pdf_files = [file for file in os.listdir(input_path) if file.endswith('.pdf')]
@@ -43,6 +46,12 @@ def main(root_dir, input_dir, output_dir):
             try:
                 run_mineru(file_path, output_path)
                 print(f"  ✓ 完成: {file}")
+
+                # 转换完成后更新全文索引
+                paper_id = file.replace('.pdf', '')
+                if db_path and paper_id.isdigit():
+                    from rag.db.search_db import index_paper_md
+                    index_paper_md(db_path, paper_id, os.path.join(output_path, paper_id, 'txt', f'{paper_id}.md'))
             except Exception as e:
                 print(f"  ✗ 失败: {file}, 错误: {e}")
             
@@ -65,10 +74,15 @@ if __name__ == '__main__':
     args.add_argument('--root_dir', type=str, default='/Users/kexu/Library/CloudStorage/OneDrive-Personal/Academy', help='The root directory of the input')
     args.add_argument('--input_dir', type=str, default='papers', help='The directory of the input')
     args.add_argument('--output_dir', type=str, default='papers_mineru', help='The directory of the output')
+    args.add_argument('--db_path', type=str, default='./export/db/academy.db', help='The path to the database file, to update the full-text index after each conversion, empty to skip the index')
     args = args.parse_args()
+
+    if args.db_path and not os.path.exists(args.db_path):
+        print(f"[ERROR] Database {args.db_path} does not exist, pass --db_path '' to convert without updating the full-text index")
+        exit(1)
     
     root_dir = args.root_dir
     input_dir = args.input_dir
     output_dir = args.output_dir
 
-    main(root_dir, input_dir, output_dir)
\ No newline at end of file
+    main(root_dir, input_dir, output_dir, args.db_path)
\ No newline at end of file
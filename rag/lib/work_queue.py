@@ -0,0 +1,155 @@
+import asyncio
+import os
+import socket
+import sqlite3
+import time
+import uuid
+
+
+class WorkQueue:
+    """
+    A per-paper job queue in SQLite, shared by any number of worker processes.
+    A worker claims jobs with a lease, which it extends with heartbeats while working. If the worker
+    crashes, the lease expires and the job is claimed again, up to max_attempts. A job is only completed
+    by the worker holding its lease, so a job whose lease was reclaimed is not completed twice.
+    """
+    def __init__(self, db_path, queue, lease_seconds=300, worker_id=None):
+        self.queue = queue
+        self.lease_seconds = lease_seconds
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}'
+        self.conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS job (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                queue TEXT,
+                paper_id TEXT,
+                priority INTEGER DEFAULT 0,
+                status TEXT DEFAULT 'pending',
+                attempts INTEGER DEFAULT 0,
+                max_attempts INTEGER DEFAULT 3,
+                lease_owner TEXT,
+                lease_expires_at REAL,
+                last_error TEXT,
+                created_at REAL,
+                updated_at REAL,
+                UNIQUE (queue, paper_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_job_claim ON job (queue, status, priority DESC, id);
+        ''')
+
+    def enqueue(self, paper_ids, priority=0, max_attempts=3):
+        """Add jobs for the papers, the papers already in the queue are ignored. Return the number of new jobs"""
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        cursor = self.conn.executemany('''
+            INSERT OR IGNORE INTO job (queue, paper_id, priority, max_attempts, created_at, updated_at) VALUES (?, ?, ?, ?, ?, ?)
+        ''', [(self.queue, str(paper_id), priority, max_attempts, now, now) for paper_id in paper_ids])
+        self.conn.execute('COMMIT')
+        return cursor.rowcount
+
+    def claim(self, n=1):
+        """Claim up to n pending jobs or jobs with an expired lease, by priority. Return their paper ids"""
+        now = time.time()
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            # Expired leases which used up their attempts will not be tried again
+            self.conn.execute('''
+                UPDATE job SET status = 'dead', last_error = 'lease expired', lease_owner = NULL, updated_at = ?
+                WHERE queue = ? AND status = 'leased' AND lease_expires_at < ? AND attempts >= max_attempts
+            ''', (now, self.queue, now))
+            rows = self.conn.execute('''
+                SELECT id, paper_id FROM job
+                WHERE queue = ? AND (status = 'pending' OR (status = 'leased' AND lease_expires_at < ?))
+                ORDER BY priority DESC, id LIMIT ?
+            ''', (self.queue, now, n)).fetchall()
+            self.conn.executemany('''
+                UPDATE job SET status = 'leased', lease_owner = ?, lease_expires_at = ?, attempts = attempts + 1, updated_at = ?
+                WHERE id = ?
+            ''', [(self.worker_id, now + self.lease_seconds, now, job_id) for job_id, _ in rows])
+            self.conn.execute('COMMIT')
+        except Exception:
+            self.conn.execute('ROLLBACK')
+            raise
+        return [paper_id for _, paper_id in rows]
+
+    def heartbeat(self, paper_ids):
+        """Extend the leases held by this worker"""
+        now = time.time()
+        self.conn.executemany('''
+            UPDATE job SET lease_expires_at = ?, updated_at = ?
+            WHERE queue = ? AND paper_id = ? AND status = 'leased' AND lease_owner = ?
+        ''', [(now + self.lease_seconds, now, self.queue, str(paper_id), self.worker_id) for paper_id in paper_ids])
+
+    def complete(self, paper_id):
+        """Mark a job done, return False if this worker no longer holds its lease"""
+        cursor = self.conn.execute('''
+            UPDATE job SET status = 'done', lease_owner = NULL, last_error = NULL, updated_at = ?
+            WHERE queue = ? AND paper_id = ? AND status = 'leased' AND lease_owner = ?
+        ''', (time.time(), self.queue, str(paper_id), self.worker_id))
+        return cursor.rowcount > 0
+
+    def fail(self, paper_id, error=''):
+        """Release a failed job to be retried, or mark it dead when it used up its attempts"""
+        cursor = self.conn.execute('''
+            UPDATE job SET status = CASE WHEN attempts >= max_attempts THEN 'dead' ELSE 'pending' END,
+                lease_owner = NULL, lease_expires_at = NULL, last_error = ?, updated_at = ?
+            WHERE queue = ? AND paper_id = ? AND status = 'leased' AND lease_owner = ?
+        ''', (str(error)[:1000], time.time(), self.queue, str(paper_id), self.worker_id))
+        return cursor.rowcount > 0
+
+    def retry_dead(self):
+        """Give the dead jobs a new round of attempts"""
+        cursor = self.conn.execute('''
+            UPDATE job SET status = 'pending', attempts = 0, updated_at = ? WHERE queue = ? AND status = 'dead'
+        ''', (time.time(), self.queue))
+        return cursor.rowcount
+
+    def stats(self):
+        return dict(self.conn.execute('SELECT status, COUNT(*) FROM job WHERE queue = ? GROUP BY status', (self.queue,)).fetchall())
+
+
+async def run_worker(queue, handle, concurrency=10, poll_interval=0):
+    """
+    Claim jobs and run handle(paper_id) on them, at most concurrency at a time, while the leases are kept
+    alive by heartbeats. handle returns (success, error). The worker stops when the queue is drained,
+    or keeps polling every poll_interval seconds if poll_interval > 0.
+    """
+    running = {}
+
+    async def heartbeat():
+        while True:
+            await asyncio.sleep(queue.lease_seconds / 3)
+            if running:
+                queue.heartbeat(list(running.values()))
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    counts = {'done': 0, 'failed': 0, 'lost': 0}
+    try:
+        while True:
+            for paper_id in queue.claim(concurrency - len(running)) if len(running) < concurrency else []:
+                running[asyncio.create_task(handle(paper_id))] = paper_id
+
+            if not running:
+                if poll_interval <= 0:
+                    break
+                await asyncio.sleep(poll_interval)
+                continue
+
+            finished, _ = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+            for task in finished:
+                paper_id = running.pop(task)
+                try:
+                    success, error = task.result()
+                except Exception as e:
+                    success, error = False, str(e)
+                if success:
+                    counts['done' if queue.complete(paper_id) else 'lost'] += 1
+                else:
+                    counts['failed' if queue.fail(paper_id, error) else 'lost'] += 1
+    finally:
+        heartbeat_task.cancel()
+
+    print(f"[INFO] Worker {queue.worker_id}: Done: {counts['done']}, Failed: {counts['failed']}, Lost lease: {counts['lost']}")
+    print(f"[INFO] Queue {queue.queue}: {queue.stats()}")
+    return counts
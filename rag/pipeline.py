@@ -0,0 +1,300 @@
+from dotenv import load_dotenv, find_dotenv
+_ = load_dotenv(find_dotenv())
+
+import argparse
+import asyncio
+import csv
+import os
+import shutil
+import sqlite3
+import threading
+import time
+
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from rag.lib.metrics import metrics
+
+
+STAGES = ['download', 'register', 'convert', 'chunk', 'embed', 'extract']
+# Register and convert give the paper its id and markdown, which the later stages need
+SKIPPABLE_STAGES = ['download', 'chunk', 'embed', 'extract']
+
+# The end of the stream, passed from stage to stage once the previous stage is done
+STOP = None
+
+
+def read_scopus_csv(scopus_csv):
+    """Read the papers of a Scopus export, with the same columns as batch_download and create_db"""
+    with open(scopus_csv, 'r', encoding='utf-8-sig') as f:
+        for row in csv.DictReader(f):
+            title, doi = row.get('文献标题'), row.get('DOI')
+            if not title or not doi:
+                continue
+            yield {
+                'title': title,
+                'doi': doi,
+                'year': int(row['年份']) if str(row.get('年份', '')).isdigit() else -1,
+                'authors': row.get('作者', ''),
+                'journal': row.get('来源出版物名称', ''),
+            }
+
+
+class Pipeline:
+    """
+    Stream every paper through download -> register -> convert -> chunk -> embed -> extract.
+    Each stage has its own pool of workers and a bounded inbox, so a paper moves on as soon as a stage is
+    done with it, and a slow stage applies back pressure instead of piling up papers in memory.
+    The heavy modules of a stage are imported when the stage starts, so starting the pipeline is fast.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.stages = [i for i in STAGES if i not in args.skip]
+        self.workers = {
+            'download': args.download_workers,
+            'register': 1,
+            'convert': args.convert_workers,
+            'chunk': args.chunk_workers,
+            'embed': args.embed_workers,
+            'extract': args.extract_workers,
+        }
+        self.queues = {stage: asyncio.Queue(maxsize=args.queue_size) for stage in self.stages}
+        self.counts = {stage: {'done': 0, 'skipped': 0, 'failed': 0} for stage in self.stages}
+        self.finished = []
+        self.deduplicator = None
+
+    async def setup(self):
+        """Import the modules and create the shared objects of the enabled stages"""
+        args = self.args
+        if 'download' in self.stages:
+            from scidownl import scihub_download
+            self.scihub_download = scihub_download
+        if 'register' in self.stages:
+            from rag.db.create_db import PaperInfo, create_db, insert_paper
+            create_db(args)
+            self.PaperInfo, self.insert_paper = PaperInfo, insert_paper
+        if 'convert' in self.stages:
+            from rag.lib.miner_u import run_mineru
+            from rag.db.search_db import index_paper_md
+            self.run_mineru, self.index_paper_md = run_mineru, index_paper_md
+        if 'chunk' in self.stages or 'embed' in self.stages:
+            from rag.embed.md_loader import get_paper_docs, get_paper_docs_recursive
+            self.get_paper_docs = get_paper_docs_recursive if args.recursive else get_paper_docs
+        if 'chunk' in self.stages:
+            if args.dedup:
+                from rag.embed.dedup_docs import ChunkDeduplicator
+                self.deduplicator = ChunkDeduplicator.load(args.dedup_index)
+                self.dedup_lock = threading.Lock()
+        if 'embed' in self.stages:
+            from rag.embed.create_embed import get_embeddings, get_vectorstore, add_paper_documents
+            self.vectorstore = get_vectorstore(args, get_embeddings())
+            self.add_paper_documents = add_paper_documents
+        if 'extract' in self.stages:
+            from rag.chat.extract_paper_info import process_paper_by_id, is_extracted
+            self.process_paper_by_id = process_paper_by_id
+            self.is_extracted = is_extracted
+            self.extract_args = argparse.Namespace(**{**vars(args), 'output_dir': args.papers_info_dir})
+            self.extract_semaphore = asyncio.Semaphore(args.extract_workers)
+
+    async def download(self, paper):
+        pdf_path = os.path.join(self.args.download_dir, f"{paper['title'].replace('/', '_')}.pdf")
+        if not os.path.exists(pdf_path):
+            await asyncio.to_thread(self.scihub_download, paper['doi'], out=pdf_path, paper_type='doi')
+            if not os.path.exists(pdf_path):
+                raise RuntimeError(f"Failed to download {paper['doi']}")
+        paper['pdf_path'] = pdf_path
+        return paper
+
+    async def register(self, paper):
+        """Insert the paper into the database and copy its pdf to {papers_dir}/{paper_id}.pdf"""
+        paper_info = self.PaperInfo()
+        paper_info.title, paper_info.doi, paper_info.year = paper['title'], paper['doi'], paper['year']
+        paper_info.authors, paper_info.journal, paper_info.file_exists = paper['authors'], paper['journal'], False
+        paper_id = await asyncio.to_thread(self.insert_paper, self.args, paper_info)
+        if paper_id is None:
+            raise RuntimeError(f"Failed to register {paper['title']}")
+        paper['paper_id'] = str(paper_id)
+
+        pdf_path = paper.get('pdf_path') or os.path.join(self.args.download_dir, f"{paper['title'].replace('/', '_')}.pdf")
+        export_path = os.path.join(self.args.papers_dir, f'{paper_id}.pdf')
+        if not os.path.exists(export_path):
+            if not os.path.exists(pdf_path):
+                raise RuntimeError(f'Pdf {pdf_path} does not exist')
+            await asyncio.to_thread(shutil.copy, pdf_path, export_path)
+        conn = sqlite3.connect(self.args.db_path)
+        try:
+            conn.execute('UPDATE paper SET file_exists = 1 WHERE id = ?', (paper_id,))
+            conn.commit()
+        finally:
+            conn.close()
+        return paper
+
+    async def convert(self, paper):
+        paper_id = paper['paper_id']
+        md_path = os.path.join(self.args.papers_mineru_dir, paper_id, 'txt', f'{paper_id}.md')
+        if not os.path.exists(md_path):
+            pdf_path = os.path.join(self.args.papers_dir, f'{paper_id}.pdf')
+            await asyncio.to_thread(self.run_mineru, pdf_path, self.args.papers_mineru_dir)
+            if not os.path.exists(md_path):
+                raise RuntimeError(f'Failed to convert {pdf_path}')
+        await asyncio.to_thread(self.index_paper_md, self.args.db_path, paper_id, md_path)
+        return paper
+
+    async def is_embedded(self, paper_id):
+        exists = await asyncio.to_thread(self.vectorstore.get, where={'paper_id': paper_id}, limit=1, include=[])
+        return len(exists['ids']) > 0
+
+    async def chunk(self, paper):
+        # Papers already embedded are not chunked again, nor added to the dedup index again
+        if 'embed' in self.stages:
+            paper['embedded'] = await self.is_embedded(paper['paper_id'])
+            if paper['embedded']:
+                paper['skipped'] = True
+                return paper
+
+        def get_docs():
+            docs = self.get_paper_docs(paper['paper_id'], self.args)
+            if self.deduplicator is not None:
+                with self.dedup_lock:
+                    docs = self.deduplicator.filter(docs)
+            return docs
+
+        paper['docs'] = await asyncio.to_thread(get_docs)
+        metrics.inc('chunks_total', len(paper['docs']), stage='chunk')
+        return paper
+
+    async def embed(self, paper):
+        docs = paper.pop('docs', None)
+        embedded = paper.pop('embedded') if 'embedded' in paper else await self.is_embedded(paper['paper_id'])
+        if embedded:
+            paper['skipped'] = True
+            return paper
+        if docs is None:
+            docs = await asyncio.to_thread(self.get_paper_docs, paper['paper_id'], self.args)
+        if docs:
+            await asyncio.to_thread(self.add_paper_documents, self.vectorstore, docs)
+            metrics.inc('chunks_total', len(docs), stage='embed')
+        return paper
+
+    async def extract(self, paper):
+        if self.is_extracted(paper['paper_id'], self.args.papers_info_dir):
+            paper['skipped'] = True
+            return paper
+        await self.process_paper_by_id(paper['paper_id'], self.extract_args, self.extract_semaphore, 0)
+        if not os.path.exists(os.path.join(self.args.papers_info_dir, f"{paper['paper_id']}.json")):
+            raise RuntimeError('No paper info extracted')
+        return paper
+
+    async def worker(self, stage, inbox, outbox):
+        """Take papers from the inbox, run the stage on them and pass them to the outbox"""
+        fn = getattr(self, stage)
+        while True:
+            paper = await inbox.get()
+            if paper is STOP:
+                # Let the other workers of the stage see the end of the stream as well
+                await inbox.put(STOP)
+                return
+            metrics.set('pipeline_queue_depth', inbox.qsize(), stage=stage)
+            try:
+                paper.pop('skipped', None)
+                with metrics.timer(stage):
+                    paper = await fn(paper)
+                status = 'skipped' if paper.pop('skipped', False) else 'done'
+            except Exception as e:
+                print(f"[ERROR] {stage} failed for {paper.get('paper_id') or paper['title']}: {e}")
+                status = 'failed'
+            self.counts[stage][status] += 1
+            # process_paper_by_id counts the extracted papers itself
+            if stage != 'extract':
+                metrics.inc('papers_total', stage=stage, status=status)
+            if status == 'failed':
+                continue
+
+            if outbox is not None:
+                await outbox.put(paper)
+            else:
+                self.finished.append(paper)
+                metrics.observe('stage_seconds', time.perf_counter() - paper['start'], stage='pipeline')
+                print(f"[INFO] Paper {paper.get('paper_id') or paper['title']} finished in {time.perf_counter() - paper['start']:.1f} s")
+
+    async def run_stage(self, stage, outbox):
+        inbox = self.queues[stage]
+        await asyncio.gather(*[self.worker(stage, inbox, outbox) for _ in range(self.workers[stage])])
+        if outbox is not None:
+            await outbox.put(STOP)
+
+    async def run(self, papers):
+        await self.setup()
+        outboxes = [self.queues[i] for i in self.stages[1:]] + [None]
+        stage_tasks = [asyncio.create_task(self.run_stage(stage, outbox)) for stage, outbox in zip(self.stages, outboxes)]
+
+        first = self.queues[self.stages[0]]
+        for paper in papers:
+            paper['start'] = time.perf_counter()
+            await first.put(paper)
+        await first.put(STOP)
+        await asyncio.gather(*stage_tasks)
+
+        for stage in self.stages:
+            counts = self.counts[stage]
+            print(f"[INFO] {stage.capitalize()}: Done: {counts['done']}, Skipped: {counts['skipped']}, Failed: {counts['failed']}")
+        print(f'[INFO] Finished papers: {len(self.finished)}')
+        if self.deduplicator is not None:
+            if self.args.dedup_index:
+                self.deduplicator.save(self.args.dedup_index)
+            self.deduplicator.report()
+
+
+async def main(args):
+    if args.metrics_dir:
+        metrics.start(args.metrics_dir, args.metrics_interval)
+
+    papers = []
+    for scopus_csv in args.scopus_csvs:
+        if not os.path.exists(scopus_csv):
+            print(f'[WARNING] Scopus csv {scopus_csv} does not exist')
+            continue
+        papers.extend(read_scopus_csv(scopus_csv))
+    print(f'[INFO] Found {len(papers)} papers in {len(args.scopus_csvs)} Scopus csv files')
+
+    await Pipeline(args).run(papers)
+
+    if args.metrics_dir:
+        metrics.stop()
+
+
+if __name__ == '__main__':
+    args = argparse.ArgumentParser()
+    args.add_argument('--scopus_csvs', type=str, nargs='+', default=['./data/scopus/ais_2005_2010.csv', './data/scopus/ais_2010_2015.csv', './data/scopus/ais_2015_2020.csv'], help='The paths to the scopus csv files')
+    args.add_argument('--download_dir', type=str, default='./export/downloads', help='The path to download the pdfs to, named by title')
+    args.add_argument('--papers_dir', type=str, default='./export/papers', help='The path to the pdfs named by paper id')
+    args.add_argument('--papers_mineru_dir', type=str, default='./export/papers_mineru', help='The path to the papers mineru directory')
+    args.add_argument('--papers_info_dir', type=str, default='./export/papers_info', help='The path to the papers info directory')
+    args.add_argument('--db_path', type=str, default='./export/db/academy.db', help='The path to the database file')
+    args.add_argument('--chroma_dir', type=str, default='./export/chroma', help='The path to the chroma directory')
+    args.add_argument('--collection_name', type=str, default='ais_basket', help='The name of the collection')
+    args.add_argument('--skip', type=str, nargs='+', default=[], choices=SKIPPABLE_STAGES, help='The stages to skip, e.g. download when the pdfs are already in the download directory')
+    args.add_argument('--queue_size', type=int, default=20, help='The maximum number of papers waiting for each stage')
+    args.add_argument('--download_workers', type=int, default=4, help='Number of concurrent downloads')
+    args.add_argument('--convert_workers', type=int, default=1, help='Number of concurrent MinerU conversions')
+    args.add_argument('--chunk_workers', type=int, default=2, help='Number of papers chunked concurrently')
+    args.add_argument('--embed_workers', type=int, default=10, help='Number of papers embedded concurrently')
+    args.add_argument('--extract_workers', type=int, default=10, help='Number of papers extracted concurrently')
+    args.add_argument('--recursive', action='store_true', help='Use recursive mode')
+    args.add_argument('--shard_by', type=str, default='none', choices=['none', 'year', 'journal'], help='Split the collection into shards by year bucket or journal')
+    args.add_argument('--year_bucket', type=int, default=5, help='Number of years in a year shard')
+    args.add_argument('--dedup', action='store_true', help='Filter boilerplate, reference lists and near-duplicate chunks before embedding')
+    args.add_argument('--dedup_index', type=str, default='./export/chroma/dedup_index.pkl', help='The path to persist the dedup index across runs')
+    args.add_argument('--model', type=str, default='gemini-2.5-flash-all', help='The model to extract the paper info')
+    args.add_argument('--map_reduce', action='store_true', help='Extract long papers section by section in parallel, then merge the results')
+    args.add_argument('--long_paper_chars', type=int, default=60000, help='Papers longer than this (in characters) use the map-reduce mode')
+    args.add_argument('--section_chars', type=int, default=12000, help='The maximum size (in characters) of a part in the map-reduce mode')
+    args.add_argument('--reduce_model', type=str, default=None, help='The model to merge the part summaries, defaults to --model')
+    args.add_argument('--part_concurrency', type=int, default=10, help='Maximum number of concurrent part requests in the map-reduce mode, across all the papers')
+    args.add_argument('--metrics_dir', type=str, default='./export/metrics/pipeline', help='The path to write the metrics (json lines and prometheus text), empty to disable')
+    args.add_argument('--metrics_interval', type=float, default=15.0, help='Interval (in seconds) between metrics writes')
+    args = args.parse_args()
+
+    for path in [args.download_dir, args.papers_dir, args.papers_mineru_dir, args.papers_info_dir, args.chroma_dir, os.path.dirname(args.db_path)]:
+        os.makedirs(path, exist_ok=True)
+
+    asyncio.run(main(args))